@@ -0,0 +1,147 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from scipy.ndimage import median_filter
+
+DEFAULT_FILTER = "median:5"
+
+_pool = None
+
+
+@lru_cache(maxsize=None)
+def selection_network(count, rank):
+    # Batcher's odd-even merge sort padded to a power of two, pruned down to the comparators the given rank depends on
+    size = 1
+    while size < count:
+        size *= 2
+
+    pairs = []
+    p = 1
+    while p < size:
+        k = p
+        while k >= 1:
+            for j in range(k % p, size - k, 2 * k):
+                for i in range(min(k, size - j - k)):
+                    if (i + j) // (p * 2) == (i + j + k) // (p * 2):
+                        pairs.append((i + j, i + j + k))
+            k //= 2
+        p *= 2
+
+    # Padding acts as +inf and never moves, comparators touching it are no-ops
+    needed = {rank}
+    kept = []
+    for a, b in reversed([(a, b) for a, b in pairs if b < count]):
+        if a in needed or b in needed:
+            kept.append((a, b))
+            needed.update((a, b))
+    return tuple(reversed(kept))
+
+
+def network_median(image, window):
+    # Exact median over a (rows, cols) window, edges are mirrored the same way as scipy's default "reflect" mode
+    rows, cols = window
+    height, width = image.shape
+    padded = np.pad(image, ((rows // 2, rows // 2), (cols // 2, cols // 2)), mode="symmetric")
+
+    # One copy of the image per window offset, the network then orders them elementwise in place
+    values = [padded[i:i + height, j:j + width].copy() for i in range(rows) for j in range(cols)]
+    buffer = np.empty_like(image)
+    rank = len(values) // 2
+    for a, b in selection_network(len(values), rank):
+        np.minimum(values[a], values[b], out=buffer)
+        np.maximum(values[a], values[b], out=values[b])
+        values[a], buffer = buffer, values[a]
+    return values[rank]
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _pool
+
+
+class MedianFilter:
+    # Windows up to this many pixels go through a sorting network, larger ones through scipy
+    NETWORK_MAX = 25
+
+    def __init__(self, size=5, threads=1):
+        if size < 1 or size % 2 == 0:
+            raise ValueError(f"Filter size has to be odd and positive, got {size}")
+        self.size = size
+        self.threads = max(1, threads)
+
+    @property
+    def name(self):
+        return f"median:{self.size}"
+
+    def windows(self):
+        return [(self.size, self.size)]
+
+    def filter_window(self, image, window):
+        if window[0] * window[1] <= self.NETWORK_MAX:
+            return network_median(image, window)
+        return median_filter(image, size=window)
+
+    def filter_band(self, image):
+        for window in self.windows():
+            image = self.filter_window(image, window)
+        return image
+
+    def __call__(self, image):
+        # Works on any dtype, for the sensor images that is the raw uint16 data
+        bands = min(self.threads, len(image) // self.size)
+        if bands < 2:
+            return self.filter_band(image)
+
+        # Row bands are filtered with a halo of neighbouring rows, which makes the result identical to a single pass
+        halo = self.size // 2
+        bounds = np.linspace(0, len(image), bands + 1).astype(int)
+        out = np.empty_like(image)
+
+        def run(start, stop):
+            top, bottom = max(0, start - halo), min(len(image), stop + halo)
+            out[start:stop] = self.filter_band(image[top:bottom])[start - top:stop - top]
+
+        list(pool().map(run, bounds[:-1], bounds[1:]))
+        return out
+
+    def __repr__(self):
+        return f"{type(self).__name__}(size={self.size}, threads={self.threads})"
+
+
+class SeparableMedianFilter(MedianFilter):
+    # Median along the rows, then along the columns. Not an exact 2D median, but close on smooth profiles and much cheaper
+
+    @property
+    def name(self):
+        return f"separable:{self.size}"
+
+    def windows(self):
+        return [(self.size, 1), (1, self.size)]
+
+
+class NoFilter:
+    name = "none"
+
+    def __call__(self, image):
+        return image
+
+    def __repr__(self):
+        return "NoFilter()"
+
+
+FILTERS = {"median": MedianFilter, "separable": SeparableMedianFilter}
+
+
+def create_filter(spec=None):
+    # "kind[:size[:threads]]", e.g. "median:5", "separable:7:4" or "none", defaults to $PROFILEPREVIEWER_DENOISE
+    spec = spec or os.environ.get("PROFILEPREVIEWER_DENOISE") or DEFAULT_FILTER
+    kind, *numbers = spec.strip().lower().split(":")
+    if kind == "none":
+        return NoFilter()
+    if kind not in FILTERS or len(numbers) > 2:
+        raise ValueError(f"Unknown filter \"{spec}\", expected one of {', '.join(FILTERS)} or none")
+    return FILTERS[kind](*(int(number) for number in numbers))
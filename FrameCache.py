@@ -0,0 +1,163 @@
+import hashlib
+import os
+import struct
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+# Folder next to the images holding the sidecar grids and the registration
+CACHE_FOLDER = ".profilepreviewer"
+
+
+def write_atomic(target, write, mode="wb"):
+    # Written under a temporary name and renamed, readers never see a partial file. Read-only archives simply stay
+    # uncached
+    temporary = f"{target}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(temporary, mode) as file:
+            write(file)
+        os.replace(temporary, target)
+    except OSError:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+class FrameCache:
+    def __init__(self, maxBytes=512 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Entries are also added by the prefetcher from its worker threads
+        self.lock = Lock()
+
+    @staticmethod
+    def key(*paths):
+        # A file rewritten in place gets a new mtime, so its old entry is never hit again and ages out
+        return tuple((os.path.abspath(path), os.stat(path).st_mtime_ns) for path in paths)
+
+    @staticmethod
+    def size_of(frames):
+        return sum(value.nbytes for frame in frames for value in frame.values() if isinstance(value, np.ndarray))
+
+    def get(self, key):
+        with self.lock:
+            frames = self.entries.get(key)
+            if frames is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return frames
+
+    def peek(self, key):
+        # Lookup that neither counts as a hit/miss nor refreshes the entry
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, frames):
+        size = self.size_of(frames)
+        with self.lock:
+            self._discard(key)
+            if size > self.maxBytes:
+                return
+
+            self.entries[key] = frames
+            self.currentBytes += size
+            while self.currentBytes > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.currentBytes -= self.size_of(evicted)
+
+    def discard(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        frames = self.entries.pop(key, None)
+        if frames is not None:
+            self.currentBytes -= self.size_of(frames)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.currentBytes = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.currentBytes, "maxBytes": self.maxBytes,
+                "hits": self.hits, "misses": self.misses}
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SidecarCache:
+    # Header, one (mtime, size) record per source image, then the filtered grids as float32 on an aligned offset
+    MAGIC = b"PPGRID01"
+    HEADER = struct.Struct("<8sIIId")
+    SOURCE = struct.Struct("<qq")
+    ALIGNMENT = 64
+    # Room for the tag, the extension and the temporary suffix below the usual 255 byte limit of a file name
+    NAME_MAX = 180
+
+    def __init__(self, folderName=CACHE_FOLDER):
+        self.folderName = folderName
+
+    def path(self, paths, tag=""):
+        # Grids filtered with different kernels are kept side by side, the tag names the filter
+        folder = os.path.dirname(os.path.abspath(paths[0]))
+        name = "+".join(os.path.basename(path) for path in paths)
+        if len(name.encode()) > self.NAME_MAX:
+            # Groups of many heads are named after their first image and a hash of all names, the header still checks
+            # every source
+            name = f"{os.path.basename(paths[0])}+{len(paths) - 1}.{hashlib.sha1(name.encode()).hexdigest()[:16]}"
+        if tag:
+            name += "." + tag.replace(":", "-")
+        return os.path.join(folder, self.folderName, name + ".grid")
+
+    def offset(self, count):
+        size = self.HEADER.size + count * self.SOURCE.size
+        return -(-size // self.ALIGNMENT) * self.ALIGNMENT
+
+    @staticmethod
+    def sources(paths):
+        return [(stat.st_mtime_ns, stat.st_size) for stat in (os.stat(path) for path in paths)]
+
+    def load(self, paths, tag=""):
+        # Returns (maxVal, grids) with the grids memory-mapped read-only, or None if missing or stale
+        try:
+            sources = self.sources(paths)
+            with open(self.path(paths, tag), "rb") as file:
+                magic, count, rows, cols, maxVal = self.HEADER.unpack(file.read(self.HEADER.size))
+                if magic != self.MAGIC or count != len(paths):
+                    return None
+                stored = [self.SOURCE.unpack(file.read(self.SOURCE.size)) for _ in range(count)]
+            if stored != sources:
+                return None
+            grids = np.memmap(self.path(paths, tag), dtype=np.float32, mode="r", offset=self.offset(count),
+                              shape=(count, rows, cols))
+        except (OSError, ValueError, struct.error):
+            return None
+        return maxVal, list(grids)
+
+    def store(self, paths, maxVal, grids, tag=""):
+        def write(file):
+            rows, cols = np.shape(grids[0])
+            file.write(self.HEADER.pack(self.MAGIC, len(grids), rows, cols, float(maxVal)))
+            for source in sources:
+                file.write(self.SOURCE.pack(*source))
+            file.write(b"\0" * (self.offset(len(grids)) - file.tell()))
+            for grid in grids:
+                np.ascontiguousarray(grid, dtype=np.float32).tofile(file)
+
+        try:
+            sources = self.sources(paths)
+        except OSError:
+            return
+        write_atomic(self.path(paths, tag), write)
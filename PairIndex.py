@@ -0,0 +1,228 @@
+import os
+import re
+from bisect import bisect_left, insort
+from collections import deque
+from threading import Lock
+
+from PyQt5.QtCore import QObject, pyqtSignal, QTimer, QAbstractListModel, QModelIndex, Qt
+
+
+class PairIndex:
+    pattern = re.compile(r"^Sensor([0-9]+)(_[_0-9]*\.png)$")
+    suffixPattern = re.compile(r"^_[_0-9]*\.png$")
+
+    def __init__(self):
+        # Timestamp suffixes of the files present for each sensor head, complete groups are their intersection
+        self.suffixes = {}
+        self.changed = False
+        self.lock = Lock()
+
+    def add(self, name):
+        # Returns the suffix if this file completes a group
+        match = self.pattern.match(name)
+        if match is None:
+            return None
+
+        sensor, suffix = match[1], match[2]
+        with self.lock:
+            if sensor not in self.suffixes:
+                # A new head makes every existing group incomplete, the listing has to be rebuilt
+                self.suffixes[sensor] = {suffix}
+                self.changed = True
+                return None
+            if suffix in self.suffixes[sensor]:
+                return None
+            self.suffixes[sensor].add(suffix)
+            return suffix if all(suffix in suffixes for suffixes in self.suffixes.values()) else None
+
+    def remove(self, name):
+        # Returns the suffix if removing this file breaks a group
+        match = self.pattern.match(name)
+        if match is None:
+            return None
+
+        sensor, suffix = match[1], match[2]
+        with self.lock:
+            if suffix not in self.suffixes.get(sensor, ()):
+                return None
+            complete = all(suffix in suffixes for suffixes in self.suffixes.values())
+            self.suffixes[sensor].discard(suffix)
+            if not self.suffixes[sensor]:
+                # Last file of a head is gone, the remaining heads may form groups again
+                del self.suffixes[sensor]
+                self.changed = True
+                return None
+            return suffix if complete else None
+
+    def take_changed(self):
+        with self.lock:
+            changed, self.changed = self.changed, False
+        return changed
+
+    def rebuild(self, names):
+        # Cheap split on the first underscore, then the same suffix pattern as add(). Every head has to be present for a
+        # group, so a stray Sensor3_notes.txt must not count as a head
+        suffixes = {}
+        for name in names:
+            if name.startswith("Sensor") and name.endswith(".png"):
+                split = name.find("_")
+                if split > 6 and name[6:split].isdigit() and self.suffixPattern.match(name[split:]):
+                    suffixes.setdefault(name[6:split], set()).add(name[split:])
+
+        with self.lock:
+            self.suffixes = suffixes
+            self.changed = False
+
+    def scan(self, path):
+        # Single directory pass, returns the sorted suffixes of complete groups
+        with os.scandir(path) as entries:
+            self.rebuild([entry.name for entry in entries])
+        return sorted(self.pairs())
+
+    def sensors(self):
+        # Head numbers present in the folder
+        with self.lock:
+            return sorted(self.suffixes, key=int)
+
+    def pairs(self):
+        with self.lock:
+            grouped = set.intersection(*self.suffixes.values()) if self.suffixes else set()
+        return list(grouped)
+
+    def __contains__(self, suffix):
+        with self.lock:
+            return bool(self.suffixes) and all(suffix in suffixes for suffixes in self.suffixes.values())
+
+
+class PairIngest(QObject):
+    DRAIN_MS = 33
+
+    paired = pyqtSignal(list)
+    unpaired = pyqtSignal(list)
+    overflowed = pyqtSignal()
+
+    def __init__(self, index, maxPending=10000):
+        super().__init__()
+        self.index = index
+        self.maxPending = maxPending
+        self.pending = deque()
+        self.removed = deque()
+        self.overflow = False
+        self.lock = Lock()
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(self.DRAIN_MS)
+        self.timer.timeout.connect(self.drain)
+        self.timer.start()
+
+    def on_created(self, event):
+        # Called from the watchdog thread, only touches the index and the queue
+        suffix = self.index.add(os.path.basename(event.src_path))
+        if suffix is None:
+            return
+
+        with self.lock:
+            if len(self.pending) >= self.maxPending:
+                self.overflow = True
+            else:
+                self.pending.append(suffix)
+
+    def on_deleted(self, event):
+        suffix = self.index.remove(os.path.basename(event.src_path))
+        if suffix is None:
+            return
+
+        with self.lock:
+            if len(self.removed) >= self.maxPending:
+                self.overflow = True
+            else:
+                self.removed.append(suffix)
+
+    def drain(self):
+        # Changes are handed to the GUI in batches, at most once per drain interval
+        # Heads appearing or disappearing change which groups are complete, that needs a full rescan
+        changed = self.index.take_changed()
+        with self.lock:
+            suffixes = list(self.pending)
+            removed = list(self.removed)
+            self.pending.clear()
+            self.removed.clear()
+            overflow, self.overflow = self.overflow, False
+
+        if overflow or changed:
+            self.overflowed.emit()
+            return
+        if removed:
+            self.unpaired.emit(removed)
+        if suffixes:
+            self.paired.emit(suffixes)
+
+
+class PairListModel(QAbstractListModel):
+    def __init__(self, placeholder=""):
+        super().__init__()
+        # Sorted suffixes, timestamps in the names make this the acquisition order
+        self.suffixes = []
+        self.placeholder = placeholder
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.suffixes) if self.suffixes else 1
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        return self.suffixes[index.row()] if self.suffixes else self.placeholder
+
+    def flags(self, index):
+        # The placeholder shown for an empty folder cannot be selected
+        return super().flags(index) if self.suffixes else Qt.NoItemFlags
+
+    def count(self):
+        return len(self.suffixes)
+
+    def suffix(self, row):
+        return self.suffixes[row] if 0 <= row < len(self.suffixes) else None
+
+    def row(self, suffix):
+        row = bisect_left(self.suffixes, suffix)
+        return row if row < len(self.suffixes) and self.suffixes[row] == suffix else -1
+
+    def set_suffixes(self, suffixes):
+        self.beginResetModel()
+        self.suffixes = sorted(suffixes)
+        self.endResetModel()
+
+    def insert(self, suffixes):
+        suffixes = sorted(suffix for suffix in set(suffixes) if self.row(suffix) < 0)
+        if not suffixes:
+            return
+        if not self.suffixes:
+            self.set_suffixes(suffixes)
+            return
+
+        # New acquisitions land after the existing rows, which makes this a single append
+        if suffixes[0] > self.suffixes[-1]:
+            self.beginInsertRows(QModelIndex(), len(self.suffixes), len(self.suffixes) + len(suffixes) - 1)
+            self.suffixes.extend(suffixes)
+            self.endInsertRows()
+            return
+
+        for suffix in suffixes:
+            row = bisect_left(self.suffixes, suffix)
+            self.beginInsertRows(QModelIndex(), row, row)
+            insort(self.suffixes, suffix)
+            self.endInsertRows()
+
+    def remove(self, suffixes):
+        for suffix in suffixes:
+            row = self.row(suffix)
+            if row < 0:
+                continue
+            if len(self.suffixes) == 1:
+                self.set_suffixes([])
+                continue
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.suffixes[row]
+            self.endRemoveRows()
@@ -0,0 +1,307 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, CancelledError, BrokenExecutor
+from threading import Lock
+
+import numpy as np
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
+
+from Profiler import profiler
+from Sensor import Sensor
+
+_sensorPool = None
+
+
+def create_executor(workers=None):
+    # Median filtering holds the GIL, processes keep the GUI thread free while decoding
+    return ProcessPoolExecutor(max_workers=workers or max(1, min(4, (os.cpu_count() or 2) - 1)))
+
+
+def sensor_pool():
+    # Threads for the heads of one group, PNG decoding and the network median both release the GIL
+    global _sensorPool
+    if _sensorPool is None:
+        _sensorPool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _sensorPool
+
+
+def load_frames(sensors, paths, process3d=False, sidecar=None):
+    # Works on fresh copies of the sensors, so it can run outside of the GUI thread. Grids already on disk are mapped
+    # instead of decoded, the prefetcher relies on that to keep sidecar reads off the GUI thread too
+    if sidecar is not None:
+        frames = load_sidecar_frames(sensors, paths, sidecar, process3d)
+        if frames is not None:
+            return frames
+
+    copies = [sensor.copy() for sensor in sensors]
+    list(sensor_pool().map(Sensor.open_image, copies, paths))
+
+    # Zero pixels are replaced with the maximum of the whole group, not of a single image
+    maxVal = np.max([np.max(sensor.imageArray) for sensor in copies])
+
+    def process(sensor):
+        sensor.maxVal = maxVal
+        sensor.process_image2d()
+        if process3d:
+            sensor.process_image3d()
+
+    list(sensor_pool().map(process, copies))
+
+    if sidecar is not None:
+        sidecar.store(paths, maxVal, [sensor.imageArray for sensor in copies], copies[0].denoise.name)
+    return tuple(sensor.frame() for sensor in copies)
+
+
+def load_sidecar_frames(sensors, paths, sidecar, process3d=False):
+    # Filtered grids stored by an earlier run are mapped instead of decoded, only the cheap 3D axes are computed
+    stored = sidecar.load(paths, sensors[0].denoise.name)
+    if stored is None:
+        return None
+
+    maxVal, grids = stored
+    copies = [sensor.copy() for sensor in sensors]
+    for sensor, grid in zip(copies, grids):
+        sensor.maxVal = maxVal
+        sensor.imageArray = grid
+        if process3d:
+            sensor.process_image3d()
+
+    return tuple(sensor.frame() for sensor in copies)
+
+
+def build_points(sensors, frames):
+    # Adds point clouds to frames that were cached after 2D processing only
+    copies = [sensor.copy() for sensor in sensors]
+    for sensor, frame in zip(copies, frames):
+        sensor.load_frame(frame)
+        if not sensor.processed3d:
+            sensor.process_image3d()
+
+    return tuple(sensor.frame() for sensor in copies)
+
+
+def record_timings(frames):
+    # Stage times measured by the sensors in the worker process, one sample per sensor
+    for frame in frames:
+        profiler.record_all(frame["timings"])
+
+
+def is_complete(frames, process3d):
+    return frames is not None and (not process3d or all(frame["processed3d"] for frame in frames))
+
+
+class Prefetcher:
+    def __init__(self, cache, sensors, executor, sidecar=None):
+        self.cache = cache
+        self.sensors = [sensor.copy() for sensor in sensors]
+        self.executor = executor
+        self.sidecar = sidecar
+        self.pending = {}
+        self.lock = Lock()
+
+    def update(self, pairs, process3d=False):
+        # Pairs are given nearest first, everything else still waiting in the queue is cancelled. Only the in-memory
+        # cache is checked here, sidecar grids are read by the workers like any other miss
+        wanted = {}
+        for paths in pairs:
+            try:
+                key = self.cache.key(*paths)
+            except FileNotFoundError:
+                continue
+            if not is_complete(self.cache.peek(key), process3d):
+                wanted[key] = paths
+
+        with self.lock:
+            for key in [key for key in self.pending if key not in wanted]:
+                self.pending.pop(key)[0].cancel()
+
+            for key, paths in wanted.items():
+                if key not in self.pending or (process3d and not self.pending[key][1]):
+                    future = self.executor.submit(load_frames, self.sensors, paths, process3d, self.sidecar)
+                    future.add_done_callback(lambda done, key=key: self.finished(key, done))
+                    self.pending[key] = (future, process3d)
+
+    def finished(self, key, future):
+        with self.lock:
+            if key in self.pending and self.pending[key][0] is future:
+                del self.pending[key]
+        try:
+            frames = future.result()
+        except (CancelledError, BrokenExecutor, OSError, ValueError):
+            return
+        record_timings(frames)
+        self.cache.put(key, frames)
+
+    def take(self, key, process3d):
+        # Hands over a decode that is already queued or running for the selected pair
+        with self.lock:
+            if key in self.pending and (self.pending[key][1] or not process3d):
+                return self.pending.pop(key)[0]
+        return None
+
+    def set_sensors(self, sensors):
+        # Queued groups of the previous head layout are of no use anymore
+        self.shutdown()
+        self.sensors = [sensor.copy() for sensor in sensors]
+
+    def shutdown(self):
+        with self.lock:
+            for future, _ in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+
+
+class FrameLoader(QObject):
+
+    loaded = pyqtSignal(object, tuple)
+    failed = pyqtSignal(str)
+    done = pyqtSignal(int, object, object)
+
+    def __init__(self, cache, sensors, executor, prefetcher=None, sidecar=None):
+        super().__init__()
+        self.cache = cache
+        self.sensors = [sensor.copy() for sensor in sensors]
+        self.executor = executor
+        self.prefetcher = prefetcher
+        self.sidecar = sidecar
+        self.sequence = 0
+        self.future = None
+        self.requested = 0.0
+        self.done.connect(self.deliver)
+
+    def set_sensors(self, sensors):
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        self.sequence += 1
+        self.sensors = [sensor.copy() for sensor in sensors]
+
+    def request(self, paths, process3d=False):
+        # Every request supersedes the previous ones, queued ones are dropped and finished ones are cached but never shown
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        self.sequence += 1
+        sequence = self.sequence
+        self.requested = time.perf_counter()
+        try:
+            key = self.cache.key(*paths)
+        except FileNotFoundError as fnfe:
+            self.failed.emit(str(fnfe))
+            return
+
+        frames = self.cache.get(key)
+        if frames is None and self.sidecar is not None:
+            with profiler.measure("sidecar"):
+                frames = load_sidecar_frames(self.sensors, paths, self.sidecar, process3d)
+            if frames is not None:
+                self.cache.put(key, frames)
+        if frames is not None and not is_complete(frames, process3d):
+            # Point clouds are implicit in the grid, adding them only computes the axes
+            frames = build_points(self.sensors, frames)
+            record_timings(frames)
+            self.cache.put(key, frames)
+        if frames is not None:
+            self.emit_loaded(key, frames)
+            return
+
+        # Decodes handed over by the prefetcher have their stage times recorded by the prefetcher
+        future = self.prefetcher.take(key, process3d) if self.prefetcher is not None else None
+        prefetched = future is not None
+        if future is None:
+            future = self.executor.submit(load_frames, self.sensors, paths, process3d, self.sidecar)
+        future.add_done_callback(lambda finished: self.finished(sequence, key, finished, not prefetched))
+        self.future = future
+
+    def finished(self, sequence, key, future, record=True):
+        # Runs on an executor thread, the result is handed to the GUI thread through a queued signal
+        if future.cancelled():
+            return
+        try:
+            frames = future.result()
+        except (BrokenExecutor, OSError, ValueError) as error:
+            self.done.emit(sequence, key, error)
+            return
+
+        if record:
+            record_timings(frames)
+        self.cache.put(key, frames)
+        self.done.emit(sequence, key, frames)
+
+    @pyqtSlot(int, object, object)
+    def deliver(self, sequence, key, result):
+        if sequence != self.sequence:
+            return
+        if isinstance(result, Exception):
+            self.failed.emit(str(result))
+        else:
+            self.emit_loaded(key, result)
+
+    def emit_loaded(self, key, frames):
+        # Time from the request to the frames being handed to the view, whether cached or decoded
+        profiler.record("load", time.perf_counter() - self.requested)
+        self.loaded.emit(key, frames)
+
+
+class JobScheduler(QObject):
+
+    failed = pyqtSignal(str)
+    done = pyqtSignal(object, int, object)
+
+    def __init__(self, workers=2):
+        super().__init__()
+        # Fixed pool shared by all slots, numpy releases the GIL so threads are enough and nothing is pickled
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+        self.sequences = {}
+        self.callbacks = {}
+        self.done.connect(self.deliver)
+
+    def submit(self, slot, callback, function, *args):
+        # One job per slot, a new one supersedes the previous: queued ones are cancelled, running ones are ignored
+        futures = [future for future in self.futures.get(slot, []) if not future.cancel() and not future.done()]
+        sequence = self.sequences.get(slot, 0) + 1
+        self.sequences[slot] = sequence
+        self.callbacks[slot] = callback
+
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(lambda finished: self.finished(slot, sequence, finished))
+        self.futures[slot] = futures + [future]
+        return sequence
+
+    def busy(self, slot):
+        # Superseded jobs keep running until they finish and may still be writing into the buffers handed to them
+        return any(not future.done() for future in self.futures.get(slot, []))
+
+    def finished(self, slot, sequence, future):
+        # Runs on a pool thread, results reach the GUI thread through a queued signal
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception as error:
+            self.done.emit(slot, sequence, error)
+            return
+        self.done.emit(slot, sequence, result)
+
+    @pyqtSlot(object, int, object)
+    def deliver(self, slot, sequence, result):
+        if sequence != self.sequences.get(slot) or slot not in self.callbacks:
+            return
+        callback = self.callbacks.pop(slot)
+        if isinstance(result, Exception):
+            self.failed.emit(str(result))
+        else:
+            callback(result)
+
+    def cancel(self, slot):
+        # Bumping the sequence drops a result that is already on its way
+        for future in self.futures.pop(slot, []):
+            future.cancel()
+        self.sequences[slot] = self.sequences.get(slot, 0) + 1
+        self.callbacks.pop(slot, None)
+
+    def shutdown(self):
+        for slot in list(self.futures):
+            self.cancel(slot)
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,90 @@
+import csv
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+import numpy as np
+
+
+@contextmanager
+def timed(timings, stage):
+    # Adds the elapsed seconds to a plain dict, used where the profiler itself is out of reach (worker processes)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+class Profiler:
+    FIELDS = ("stage", "count", "p50", "p95", "max")
+
+    def __init__(self, window=500):
+        # Rolling window of the last samples per stage, in seconds
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+        self.enabled = True
+        self.lock = Lock()
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.window)
+                self.counts[stage] = 0
+            self.samples[stage].append(seconds)
+            self.counts[stage] += 1
+
+    def record_all(self, timings, prefix=""):
+        for stage, seconds in timings.items():
+            self.record(prefix + stage, seconds)
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def summary(self):
+        # Percentiles in milliseconds, stages in the order they were first seen
+        with self.lock:
+            samples = {stage: np.array(values) for stage, values in self.samples.items()}
+            counts = dict(self.counts)
+
+        return [{"stage": stage, "count": counts[stage],
+                 "p50": float(np.percentile(values, 50)) * 1000,
+                 "p95": float(np.percentile(values, 95)) * 1000,
+                 "max": float(np.max(values)) * 1000} for stage, values in samples.items()]
+
+    def format(self, separator=" | "):
+        return separator.join(f"{row['stage']} {row['p50']:.1f}/{row['p95']:.1f}/{row['max']:.1f} ms"
+                              for row in self.summary())
+
+    def dump(self, path):
+        # JSON for .json paths, CSV otherwise
+        rows = self.summary()
+        if path.lower().endswith(".json"):
+            with open(path, "w") as file:
+                json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "window": self.window, "stages": rows},
+                          file, indent=2)
+            return
+
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=self.FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.counts.clear()
+
+
+# Shared by everything running in the GUI process
+profiler = Profiler()
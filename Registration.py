@@ -0,0 +1,224 @@
+import json
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.transform import Rotation
+
+from FrameCache import CACHE_FOLDER, write_atomic
+from Sensor import transform_grid
+
+
+def sample_cloud(sensor, stride):
+    # Decimated cloud in the sensor's current pose with grid normals, without the zero pixels that were filled with the
+    # background level
+    xAxis, yAxis, zGrid, zBase = sensor.grid()
+    zGrid = zGrid[::stride, ::stride]
+    pointsArray = transform_grid(xAxis[::stride], yAxis[::stride], zGrid, zBase, sensor.pose_matrix(),
+                                 np.empty((zGrid.size, 3), dtype=np.float32)).astype(np.float64)
+
+    # Neighbouring grid points span the surface, no neighbour search is needed for the normals
+    grid = pointsArray.reshape(zGrid.shape + (3,))
+    normals = np.cross(np.gradient(grid, axis=0), np.gradient(grid, axis=1)).reshape(-1, 3)
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True) + 1e-12
+
+    valid = (zGrid > np.float32(-sensor.zStep * sensor.maxVal + sensor.zStep / 2)).ravel()
+    return pointsArray[valid], normals[valid]
+
+
+def crop_overlap(fixed, moving, margin):
+    # Only the common X/Y extent of both clouds, grown by the margin, takes part in the matching
+    low = np.maximum(fixed.min(axis=0), moving.min(axis=0)) - margin
+    high = np.minimum(fixed.max(axis=0), moving.max(axis=0)) + margin
+    return [np.all((pointsArray[:, :2] >= low[:2]) & (pointsArray[:, :2] <= high[:2]), axis=1)
+            for pointsArray in (fixed, moving)]
+
+
+def height_profile(sensor, stride, binSize):
+    # Mean height of the posed cloud per X bin, NaN where a bin is empty
+    pointsArray, _ = sample_cloud(sensor, stride)
+    bins = np.floor(pointsArray[:, 0] / binSize).astype(int)
+    start = int(bins.min())
+    counts = np.bincount(bins - start)
+    sums = np.bincount(bins - start, pointsArray[:, 2])
+    profile = np.full(len(counts), np.nan)
+    profile[counts > 0] = sums[counts > 0] / counts[counts > 0]
+    return start, profile
+
+
+def profile_scores(fixed, moving, binSize, minOverlap, stride):
+    # Residual of the height difference after removing a tilt along X, for every shift of the moving profile in bins.
+    # It is weighted by the part of the moving profile left uncovered, so a short lucky overlap does not win
+    fixedStart, fixedProfile = height_profile(fixed, stride, binSize)
+    movingStart, movingProfile = height_profile(moving, stride, binSize)
+    total = np.count_nonzero(~np.isnan(movingProfile))
+    columns = np.arange(len(movingProfile))
+    scores = {}
+    for shift in range(fixedStart - movingStart - len(movingProfile), fixedStart - movingStart + len(fixedProfile)):
+        target = columns + movingStart - fixedStart + shift
+        inside = (target >= 0) & (target < len(fixedProfile))
+        difference = fixedProfile[target[inside]] - movingProfile[inside]
+        valid = ~np.isnan(difference)
+        count = np.count_nonzero(valid)
+        if count < minOverlap * total:
+            continue
+        x = columns[inside][valid].astype(np.float64)
+        design = np.stack((x, np.ones_like(x)), axis=1)
+        coefficients, *_ = np.linalg.lstsq(design, difference[valid], rcond=None)
+        scores[shift] = np.sqrt(np.mean((difference[valid] - design @ coefficients) ** 2)) * np.sqrt(total / count)
+    return scores
+
+
+def coarse_offset(fixed, moving, binSize=1.0, minOverlap=0.2, stride=4, window=10.0, ambiguity=0.8):
+    # Global search over the X offset on height profiles, scored over all frames together. ICP only converges from
+    # within about a centimetre, this gets it there from any pose. A repetitive surface can fit in several places in a
+    # single frame, a runner-up that scores nearly as well is reported instead of guessed
+    scores = [profile_scores(fixedSensor, movingSensor, binSize, minOverlap, stride)
+              for fixedSensor, movingSensor in zip(fixed, moving)]
+    shifts = np.array(sorted(set.intersection(*(set(frameScores) for frameScores in scores))))
+    if len(shifts) == 0:
+        raise ValueError(f"{fixed[0].prefix} and {moving[0].prefix} never overlap in {minOverlap:.0%} of the points")
+
+    joint = np.mean([[frameScores[shift] for shift in shifts] for frameScores in scores], axis=0)
+    best = np.argmin(joint)
+    distant = np.abs(shifts - shifts[best]) * binSize > window
+    if np.any(distant) and joint[best] > ambiguity * np.min(joint[distant]):
+        other = shifts[distant][np.argmin(joint[distant])]
+        raise ValueError(f"{moving[0].prefix} fits {fixed[0].prefix} at X {shifts[best] * binSize:+.0f} mm and at "
+                         f"{other * binSize:+.0f} mm about equally well in {len(fixed)} frame(s), "
+                         f"cache more frames of the folder or set a rough pose first")
+    return float(shifts[best] * binSize)
+
+
+def icp(fixed, normals, moving, iterations=50, tolerance=0.05, angleTolerance=0.01, trim=0.8):
+    # Point to plane ICP, linearized for small rotations, over several frames at once: every frame has its own fixed
+    # surface and moving points, all of them share one correction. Matching against the fixed surface instead of its
+    # samples lets the decimated clouds settle between grid points, the worst matches of every iteration are dropped
+    # so parts outside the true overlap do not pull. The shift along the travel axis (Y) comes from the encoder timing
+    # rather than the mounting and differs from frame to frame, every frame gets its own. Returns the correction of the
+    # first frame. Stops once a step moves less than the tolerances (mm, degrees)
+    trees = [cKDTree(fixedCloud) for fixedCloud in fixed]
+    # Rotations are linearized around the centre of the moving points, which keeps them apart from the translations
+    centre = np.mean(np.concatenate(moving), axis=0)
+    clouds = [movingCloud - centre for movingCloud in moving]
+    corrections = [np.identity(4) for _ in clouds]
+    rms = np.inf
+    for iteration in range(1, iterations + 1):
+        rows, residuals = [], []
+        for frame, (tree, fixedCloud, fixedNormals, pointsArray) in enumerate(zip(trees, fixed, normals, clouds)):
+            distances, indices = tree.query(pointsArray + centre, workers=-1)
+            keep = distances <= np.quantile(distances, trim)
+            source, target, normal = pointsArray[keep], fixedCloud[indices[keep]] - centre, fixedNormals[indices[keep]]
+            residuals.append(np.einsum('ij,ij->i', target - source, normal))
+            # Shared rotation, X and Z shift, then one Y column per frame
+            travel = np.zeros((len(source), len(clouds)))
+            travel[:, frame] = normal[:, 1]
+            rows.append(np.hstack((np.cross(source, normal), normal[:, [0, 2]], travel)))
+        residuals = np.concatenate(residuals)
+        solution, *_ = np.linalg.lstsq(np.concatenate(rows), residuals, rcond=None)
+
+        for frame, travel in enumerate(solution[5:]):
+            step = np.identity(4)
+            step[:3, :3] = Rotation.from_rotvec(solution[:3]).as_matrix()
+            step[:3, 3] = solution[3], travel, solution[4]
+            clouds[frame] = clouds[frame] @ step[:3, :3].T + step[:3, 3]
+            corrections[frame] = step @ corrections[frame]
+        rms = float(np.sqrt(np.mean(residuals ** 2)))
+        if np.linalg.norm(solution[3:]) < tolerance and np.degrees(np.linalg.norm(solution[:3])) < angleTolerance:
+            break
+    else:
+        iteration = None
+
+    # Back from the centred frame: x -> C (x - c) + c
+    shift = np.identity(4)
+    shift[:3, 3] = centre
+    unshift = np.identity(4)
+    unshift[:3, 3] = -centre
+    return shift @ corrections[0] @ unshift, rms, iteration or iterations, iteration is not None
+
+
+def set_pose(sensors, pose):
+    for sensor in sensors:
+        sensor.xOffset, sensor.yOffset, sensor.zOffset, sensor.xAngle, sensor.yAngle, sensor.zAngle = pose
+
+
+def register(fixed, moving, targetPoints=20000, margin=10.0, minOverlap=0.2, maxShift=20.0, maxTurn=5.0):
+    # Aligns the moving head with the fixed one over one or more frames, given as lists of sensors of the two heads in
+    # the same order. Returns the pose of the moving head, the RMS distance and the iterations used. The X offset comes
+    # from the coarse search, ICP then refines it from there. A fit that does not settle, barely overlaps or wanders
+    # far from the coarse start is rejected instead of returned
+    start = list(moving[0].pose())
+    start[0] += coarse_offset(fixed, moving, minOverlap=minOverlap)
+    set_pose(moving, start)
+
+    # The point budget is shared by the frames, the fixed surfaces are sampled twice as densely as the moving points
+    stride = max(1, int(np.ceil(np.sqrt(moving[0].imageArray.size * len(moving) / targetPoints))))
+    fixedClouds, normals, movingClouds = [], [], []
+    movingTotal = 0
+    for fixedSensor, movingSensor in zip(fixed, moving):
+        fixedCloud, fixedNormals = sample_cloud(fixedSensor, max(1, stride // 2))
+        movingCloud, _ = sample_cloud(movingSensor, stride)
+        fixedMask, movingMask = crop_overlap(fixedCloud, movingCloud, margin)
+        fixedClouds.append(fixedCloud[fixedMask])
+        normals.append(fixedNormals[fixedMask])
+        movingClouds.append(movingCloud[movingMask])
+        movingTotal += len(movingCloud)
+    overlap = sum(len(movingCloud) for movingCloud in movingClouds) / max(1, movingTotal)
+    if overlap < minOverlap or any(len(fixedCloud) == 0 for fixedCloud in fixedClouds):
+        raise ValueError(f"{fixed[0].prefix} and {moving[0].prefix} overlap in {overlap:.0%} of the points only, "
+                         f"set a rough pose first")
+
+    correction, rms, iterations, converged = icp(fixedClouds, normals, movingClouds)
+    if not converged:
+        raise ValueError(f"Registration of {moving[0].prefix} did not converge in {iterations} iterations "
+                         f"(RMS {rms:.2f} mm), set a closer pose first")
+
+    # The travel offset is kept as it was, only the mounting is taken from the fit
+    pose = list(moving[0].pose_from_matrix(correction @ moving[0].pose_matrix()))
+    pose[1] = start[1]
+    pose = tuple(pose)
+    shift = np.linalg.norm(np.subtract(pose[:3], start[:3]))
+    turn = np.max(np.abs((np.subtract(pose[3:], start[3:]) + 180) % 360 - 180))
+    if shift > maxShift or turn > maxTurn:
+        raise ValueError(f"Registration of {moving[0].prefix} moved it by {shift:.1f} mm and {turn:.1f}°, more than "
+                         f"the allowed {maxShift:.0f} mm and {maxTurn:.0f}°, set a closer pose first")
+    return pose, rms, iterations
+
+
+def register_all(frames, **kwargs):
+    # Frames are lists of sensors in panel order, all of them in the same poses. Every head is aligned with its
+    # neighbour, the first one stays where it is. Returns the poses and the (RMS, iterations) of every pair
+    poses = [frames[0][0].pose()]
+    results = []
+    for index in range(1, len(frames[0])):
+        pose, rms, iterations = register([frame[index - 1] for frame in frames], [frame[index] for frame in frames],
+                                         **kwargs)
+        set_pose([frame[index] for frame in frames], pose)
+        poses.append(pose)
+        results.append((rms, iterations))
+    return poses, results
+
+
+class RegistrationCache:
+    # Poses found for a folder, stored next to the sidecar grids and restored when the folder is opened again
+
+    def __init__(self, folderName=CACHE_FOLDER, fileName="registration.json"):
+        self.folderName = folderName
+        self.fileName = fileName
+
+    def path(self, folder):
+        return os.path.join(folder, self.folderName, self.fileName)
+
+    def load(self, folder):
+        try:
+            with open(self.path(folder)) as file:
+                poses = json.load(file)["poses"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+        return {prefix: tuple(float(value) for value in pose) for prefix, pose in poses.items() if len(pose) == 6}
+
+    def store(self, folder, poses):
+        write_atomic(self.path(folder),
+                     lambda file: json.dump({"poses": {prefix: list(pose) for prefix, pose in poses.items()}}, file,
+                                            indent=2),
+                     "w")
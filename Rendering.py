@@ -0,0 +1,197 @@
+import numpy as np
+from PyQt5.QtCore import QObject, QEvent, QTimer, pyqtSignal
+from PyQt5.QtGui import QMatrix4x4
+from pyqtgraph import opengl as gl
+
+from Profiler import profiler
+
+
+def to_qmatrix(matrix):
+    # QMatrix4x4 takes its values row by row, same as a numpy array in C order
+    return QMatrix4x4(*np.asarray(matrix, dtype=float).ravel().tolist())
+
+
+def pose_transform(matrix, scale, zShift=0.0):
+    # Model matrix of a GL item holding untransformed sensor data: view scale * sensor pose * Z shift
+    shift = np.identity(4)
+    shift[2, 3] = zShift
+    return to_qmatrix(np.diag((scale, scale, scale, 1.0)) @ matrix @ shift)
+
+
+def decimate_points(pointsArray, shape, stride):
+    # Points are stored row-major over the image grid, so decimation is a strided view of the grid
+    return np.ascontiguousarray(pointsArray.reshape(shape + (-1,))[::stride, ::stride].reshape(-1, pointsArray.shape[1]))
+
+
+class LodScatter:
+    def __init__(self, item, pointBudget):
+        self.item = item
+        self.pointBudget = pointBudget
+        # Pyramid of (points, colors, shape), finest first, each level half the resolution of the previous one
+        self.levels = []
+        self.coarse = False
+
+    def set_data(self, pointsArray, colors, shape):
+        self.levels = [(pointsArray, colors, tuple(shape))]
+        while len(self.levels[-1][0]) > self.pointBudget and max(self.levels[-1][2]) > 1:
+            points, color, shape = self.levels[-1]
+            self.levels.append((decimate_points(points, shape, 2), decimate_points(color, shape, 2),
+                                (-(-shape[0] // 2), -(-shape[1] // 2))))
+        self.show()
+
+    def set_coarse(self, coarse):
+        if coarse != self.coarse:
+            self.coarse = coarse
+            self.show()
+
+    def show(self):
+        if not self.levels:
+            return
+        pointsArray, colors, _ = self.levels[-1] if self.coarse else self.levels[0]
+        self.item.setData(pos=pointsArray, color=colors)
+
+    def clear(self):
+        self.levels = []
+        self.item.setData(pos=None, color=None)
+
+
+class HeightMapSurface:
+    def __init__(self, hostView, scale):
+        self.hostView = hostView
+        self.scale = scale
+        self.zBase = 0.0
+        # Vertex colors make normals unnecessary, skipping them keeps the one-time upload cheap
+        self.item = gl.GLSurfacePlotItem(computeNormals=False, smooth=False)
+        self.item.setGLOptions('opaque')
+        self.item.setVisible(False)
+        hostView.addItem(self.item)
+
+    def set_grid(self, grid, colors):
+        # Uploaded once per frame, the grid is the untransformed image with zBase applied through the model matrix
+        xAxis, yAxis, zGrid, self.zBase = grid
+        self.item.setData(x=xAxis, y=yAxis, z=zGrid, colors=colors.reshape(zGrid.shape + (4,)))
+
+    def set_pose(self, matrix):
+        self.item.setTransform(pose_transform(matrix, self.scale, -self.zBase))
+
+    def set_visible(self, visible):
+        self.item.setVisible(visible)
+
+    def remove(self):
+        self.hostView.removeItem(self.item)
+
+
+class RollingVolume:
+    def __init__(self, hostView, capacity, scale, pointSize, stride=1):
+        self.hostView = hostView
+        self.capacity = capacity
+        self.scale = scale
+        self.stride = stride
+        # Ring of the last frames, one GL item per slot so a new frame only re-uploads the slot it overwrites
+        self.items = []
+        for _ in range(capacity):
+            item = gl.GLScatterPlotItem(size=pointSize, pxMode=False)
+            item.setGLOptions('opaque')
+            item.setVisible(False)
+            hostView.addItem(item)
+            self.items.append(item)
+        self.points = None
+        self.colors = None
+        self.positions = [None] * capacity
+        self.newest = None
+        self.length = 0.0
+        self.matrix = np.identity(4)
+        self.visible = False
+
+    def allocate(self, shape, channels):
+        # Preallocated once for the frame size, appending never allocates
+        rows, cols = -(-shape[0] // self.stride), -(-shape[1] // self.stride)
+        if self.points is None or self.points.shape[1:3] != (rows, cols):
+            self.points = np.empty((self.capacity, rows, cols, 3), dtype=np.float32)
+            self.colors = np.empty((self.capacity, rows, cols, channels), dtype=np.float32)
+            self.positions = [None] * self.capacity
+
+    def append(self, position, pointsArray, colors, shape, length):
+        # Position is the frame's place along the travel axis, the slot it lands in is position modulo the capacity
+        self.allocate(shape, colors.shape[1])
+        slot = position % self.capacity
+        np.copyto(self.points[slot], pointsArray.reshape(shape + (3,))[::self.stride, ::self.stride])
+        np.copyto(self.colors[slot], colors.reshape(shape + (-1,))[::self.stride, ::self.stride])
+        self.positions[slot] = position
+        self.newest = position if self.newest is None else max(self.newest, position)
+        self.length = length
+
+        self.items[slot].setData(pos=self.points[slot].reshape(-1, 3),
+                                 color=self.colors[slot].reshape(-1, self.colors.shape[-1]))
+        self.update_transforms()
+
+    def update_transforms(self):
+        # Older frames are moved back along Y through their model matrices, their vertex data stays untouched
+        for item, position in zip(self.items, self.positions):
+            if position is None or not 0 <= self.newest - position < self.capacity:
+                item.setVisible(False)
+                continue
+            travel = np.identity(4)
+            travel[1, 3] = (self.newest - position) * self.length
+            item.setTransform(pose_transform(travel @ self.matrix, self.scale))
+            item.setVisible(self.visible)
+
+    def set_pose(self, matrix):
+        self.matrix = matrix
+        self.update_transforms()
+
+    def set_visible(self, visible):
+        self.visible = visible
+        self.update_transforms()
+
+    def clear(self, release=False):
+        self.positions = [None] * self.capacity
+        self.newest = None
+        for item in self.items:
+            item.setVisible(False)
+            item.setData(pos=None, color=None)
+        if release:
+            self.points = None
+            self.colors = None
+
+    def remove(self):
+        for item in self.items:
+            self.hostView.removeItem(item)
+
+
+class ProfiledGLView(gl.GLViewWidget):
+    def paintGL(self, *args, **kwargs):
+        # Vertex data set on the items is uploaded lazily, so the first paint after a new frame includes the upload
+        with profiler.measure("render"):
+            super().paintGL(*args, **kwargs)
+
+
+class InteractionMonitor(QObject):
+
+    moving = pyqtSignal()
+    idle = pyqtSignal()
+
+    def __init__(self, widget, idleMs=250):
+        super().__init__()
+        self.active = False
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(idleMs)
+        self.timer.timeout.connect(self.finish)
+        widget.installEventFilter(self)
+
+    def eventFilter(self, watched, event):
+        # Orbiting and panning are mouse drags, zooming is the wheel
+        if event.type() == QEvent.Wheel or (event.type() == QEvent.MouseMove and event.buttons()):
+            self.start()
+        return False
+
+    def start(self):
+        self.timer.start()
+        if not self.active:
+            self.active = True
+            self.moving.emit()
+
+    def finish(self):
+        self.active = False
+        self.idle.emit()
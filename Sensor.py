@@ -1,32 +1,112 @@
-import time
-
 import PIL.Image
 import numpy as np
 from PyQt5.QtCore import pyqtSignal, QObject, pyqtSlot
-from scipy.ndimage import median_filter
 from scipy.spatial.transform import Rotation
 
+from Denoise import create_filter
+from Profiler import profiler, timed
+
+
+def height_colormap(pointsArray, out):
+    # Red/green from exponentially scaled height, blue from normalized Y
+    maxZ = np.max(pointsArray[:, 2])
+    maxY = np.max(pointsArray[:, 1])
+    np.subtract(pointsArray[:, 2], maxZ, out=out[:, 1])
+    np.multiply(out[:, 1], 0.04, out=out[:, 1])
+    np.exp(out[:, 1], out=out[:, 1])
+    np.subtract(1, out[:, 1], out=out[:, 0])
+    np.divide(pointsArray[:, 1], maxY, out=out[:, 2])
+    out[:, 3] = 0.5
+
+
+class LutColormap:
+    def __init__(self, lut, axis=2, alpha=None):
+        self.lut = np.ascontiguousarray(lut, dtype=np.float32)
+        if self.lut.ndim != 2 or self.lut.shape[1] not in (3, 4):
+            raise ValueError("LUT has to be an array of shape (N, 3) or (N, 4)")
+        self.axis = axis
+        self.alpha = alpha
+        self.scaled = None
+        self.indices = None
+
+    @classmethod
+    def from_pyqtgraph(cls, name, points=256, axis=2, alpha=None):
+        from pyqtgraph import colormap
+        return cls(colormap.get(name).getLookupTable(nPts=points, mode='float', alpha=True), axis, alpha)
+
+    def __call__(self, pointsArray, out):
+        values = pointsArray[:, self.axis]
+        minVal = np.min(values)
+        span = np.max(values) - minVal
+        scale = (len(self.lut) - 1) / span if span > 0 else 0.0
+
+        # Index buffers are kept between calls, same as the color buffer
+        if self.indices is None or self.indices.shape[0] != values.shape[0]:
+            self.scaled = np.empty(values.shape[0], dtype=np.float32)
+            self.indices = np.empty(values.shape[0], dtype=np.intp)
+        np.subtract(values, minVal, out=self.scaled)
+        np.multiply(self.scaled, scale, out=self.scaled)
+        np.rint(self.scaled, out=self.scaled)
+        self.indices[:] = self.scaled
+
+        np.take(self.lut[:, :3], self.indices, axis=0, out=out[:, :3])
+        if self.alpha is not None:
+            out[:, 3] = self.alpha
+        elif self.lut.shape[1] == 4:
+            np.take(self.lut[:, 3], self.indices, out=out[:, 3])
+        else:
+            out[:, 3] = 1.0
+
+
+def generate_colors(pointsArray, colormap=height_colormap, buffer=None):
+    # Same job as ColormapWorker without the QObject, for thread pools
+    with profiler.measure("colormap"):
+        buffer = ColormapWorker.allocate(pointsArray, buffer)
+        colormap(pointsArray, buffer)
+    return buffer
+
+
+def grid_colors(grid, colormap=height_colormap):
+    # Colors of an implicit grid cloud, the untransformed points are only materialized for the colormap
+    xAxis, yAxis, zGrid, zBase = grid
+    return generate_colors(transform_grid(xAxis, yAxis, zGrid, zBase, np.identity(4),
+                                          np.empty((zGrid.size, 3), dtype=np.float32)), colormap)
+
 
 class ColormapWorker(QObject):
 
     finished = pyqtSignal(np.ndarray)
 
-    def __init__(self, pointsArray):
+    def __init__(self, pointsArray, colormap=height_colormap, buffer=None):
         super().__init__()
         self.pointsArray = pointsArray
+        self.colormap = colormap
+        self.buffer = buffer
+
+    @staticmethod
+    def allocate(pointsArray, buffer=None):
+        # Reuse the previous RGBA buffer if it still fits the point cloud
+        if buffer is None or buffer.shape != (np.shape(pointsArray)[0], 4) or buffer.dtype != np.float32:
+            buffer = np.empty((np.shape(pointsArray)[0], 4), dtype=np.float32)
+        return buffer
 
     @pyqtSlot()
     def generate_colormap(self):
-        colors = np.empty((np.shape(self.pointsArray)[0], 4))
-        maxZ = np.max(self.pointsArray[:, 2])
-        maxY = np.max(self.pointsArray[:, 1])
-        norm = np.exp(0.04 * (self.pointsArray[:, 2] - maxZ))
-        normY = self.pointsArray[:, 1] / maxY
-        for i in range(np.shape(colors)[0]):
-            val = norm[i]
-            colors[i] = (1 - val, val, normY[i], 0.5)
+        self.buffer = generate_colors(self.pointsArray, self.colormap, self.buffer)
+        self.finished.emit(self.buffer)
+
 
-        self.finished.emit(colors)
+def transform_grid(xAxis, yAxis, zGrid, zBase, matrix, out):
+    # Point (i, j) of the grid is (xAxis[i], yAxis[j], zGrid[i, j] - zBase), the Z shift is folded into the translation
+    rotation = matrix[:3, :3].astype(np.float32)
+    translation = (matrix[:3, 3] - matrix[:3, 2] * zBase).astype(np.float32)
+
+    grid = out.reshape(len(xAxis), len(yAxis), 3)
+    for axis in range(3):
+        np.multiply(zGrid, rotation[axis, 2], out=grid[:, :, axis])
+        grid[:, :, axis] += (xAxis * rotation[axis, 0] + translation[axis])[:, np.newaxis]
+        grid[:, :, axis] += (yAxis * rotation[axis, 1])[np.newaxis, :]
+    return out
 
 
 class Sensor:
@@ -34,7 +114,7 @@ class Sensor:
     yStep = 1
     zStep = 0.006
 
-    def __init__(self, prefix, isOffset=False):
+    def __init__(self, prefix, isOffset=False, denoise=None, lane=0):
         super().__init__()
         self.prefix: str = prefix
         self.maxVal: float = 0.0
@@ -45,58 +125,115 @@ class Sensor:
         self.yAngle: float = 0.0
         self.zAngle: float = 0.0
         self.imageArray = None
-        self.unprocessedPointsArray = None
+        self.xAxis = None
+        self.yAxis = None
+        self.zBase: float = 0.0
         self.pointsArray = None
+        self.meanX: float = 0.0
         self.colormap = None
         self.isOffset = isOffset
+        # Default place on X in head widths, so more than two heads start side by side instead of on top of each other
+        self.lane = lane
         self.processed3d = False
+        self.denoise = denoise if denoise is not None else create_filter()
+        # Seconds spent per processing stage on the current frame, shipped back from the worker processes with it
+        self.timings = {}
+
+    def path(self, folder, suffix):
+        return f"{folder}/{self.prefix}{suffix}"
+
+    def copy(self):
+        # Same setup without any frame data, for processing outside of the GUI thread
+        return Sensor(self.prefix, isOffset=self.isOffset, denoise=self.denoise, lane=self.lane)
 
     def open_image(self, path: str):
         self.processed3d = False
-        self.imageArray = np.asarray(PIL.Image.open(path).transpose(PIL.Image.ROTATE_270))
+        self.timings = {}
+        with timed(self.timings, "decode"):
+            self.imageArray = np.array(PIL.Image.open(path).transpose(PIL.Image.ROTATE_270))
+
+    def frame(self):
+        return {"maxVal": self.maxVal, "imageArray": self.imageArray, "processed3d": self.processed3d,
+                "xAxis": self.xAxis, "yAxis": self.yAxis, "zBase": self.zBase, "meanX": self.meanX,
+                "timings": dict(self.timings)}
+
+    def load_frame(self, frame):
+        # Cached arrays are shared, processing always replaces them instead of writing in place
+        self.maxVal = frame["maxVal"]
+        self.imageArray = frame["imageArray"]
+        self.processed3d = frame["processed3d"]
+        self.xAxis = frame["xAxis"]
+        self.yAxis = frame["yAxis"]
+        self.zBase = frame["zBase"]
+        self.meanX = frame["meanX"]
+        self.timings = {}
 
     def process_image2d(self):
-        self.imageArray[self.imageArray == 0] = self.maxVal
-        self.imageArray = self.imageArray * -self.zStep
-        self.imageArray = median_filter(self.imageArray, size=5)
+        with timed(self.timings, "denoise"):
+            self.imageArray[self.imageArray == 0] = self.maxVal
+            # The median commutes with the negative scale, so the filter runs on the raw uint16 values
+            self.imageArray = np.multiply(self.denoise(self.imageArray), np.float32(-self.zStep), dtype=np.float32)
 
     def process_image3d(self):
-        shape = np.shape(self.imageArray)
-        x = np.linspace(0, shape[0], shape[0]) * self.xStep
-        y = np.linspace(0, shape[1], shape[1]) * self.yStep
-
-        self.pointsArray = np.zeros((shape[0] * shape[1], 3))
-        self.pointsArray[:, 0] = np.repeat(x, shape[1])
-        self.pointsArray[:, 1] = np.tile(y, shape[0])
-        self.pointsArray[:, 2] = np.reshape(self.imageArray, (shape[0]*shape[1]))
-
-        yOffset = np.max(self.pointsArray[:, 1])
-        zOffset = np.mean(self.pointsArray[np.where((self.pointsArray[:, 1] == np.max(self.pointsArray[:, 1]))), 2])
-        self.pointsArray[:, 1] = -(self.pointsArray[:, 1] - yOffset)
-        self.pointsArray[:, 2] = self.pointsArray[:, 2] - zOffset
-
-        if self.isOffset:
-            self.pointsArray[:, 0] -= np.max(self.pointsArray[:, 0])
-
-        self.unprocessedPointsArray = self.pointsArray.copy()
-
-        self.transform()
-        self.processed3d = True
-
-    def transform(self):
-        self.pointsArray = self.unprocessedPointsArray.copy()
-        if self.xAngle != 0.0:
-            rx = Rotation.from_euler('x', self.xAngle, degrees=True)
-            self.pointsArray = rx.apply(self.pointsArray)
-
-        if self.yAngle != 0.0 or self.zAngle != 0.0:
-            ryz = Rotation.from_euler('yz', [self.yAngle, self.zAngle], degrees=True)
-            meanX = np.mean(self.pointsArray[:, 0])
-            self.pointsArray[:, 0] = self.pointsArray[:, 0] - meanX
-            self.pointsArray = ryz.apply(self.pointsArray)
-            self.pointsArray[:, 0] = self.pointsArray[:, 0] + meanX
-
-        self.pointsArray[:, 0] += self.xOffset
-        self.pointsArray[:, 1] += self.yOffset
-        self.pointsArray[:, 2] += self.zOffset
-
+        with timed(self.timings, "process3d"):
+            shape = np.shape(self.imageArray)
+            x = np.linspace(0, shape[0], shape[0]) * self.xStep
+            y = np.linspace(0, shape[1], shape[1]) * self.yStep
+
+            # The cloud is kept implicit: X and Y per grid row/column, Z is the image itself shifted by zBase
+            self.xAxis = (x - np.max(x) if self.isOffset else x + self.lane * np.max(x)).astype(np.float32)
+            self.yAxis = (-(y - np.max(y))).astype(np.float32)
+            self.zBase = float(np.mean(self.imageArray[:, -1]))
+            self.meanX = float(np.mean(self.xAxis))
+            self.processed3d = True
+
+    def grid(self):
+        if self.xAxis is None or self.imageArray is None or self.imageArray.shape != (len(self.xAxis), len(self.yAxis)):
+            return None
+        return self.xAxis, self.yAxis, self.imageArray, self.zBase
+
+    def points(self):
+        # Untransformed (N, 3) cloud, only materialized on request
+        return transform_grid(*self.grid(), np.identity(4), np.empty((self.imageArray.size, 3), dtype=np.float32))
+
+    def pose(self):
+        return self.xOffset, self.yOffset, self.zOffset, self.xAngle, self.yAngle, self.zAngle
+
+    def pose_matrix(self, pose=None):
+        xOffset, yOffset, zOffset, xAngle, yAngle, zAngle = self.pose() if pose is None else pose
+
+        # Rotation around X, then around Y and Z pivoted on the mean X of the cloud, then the offsets
+        rx = Rotation.from_euler('x', xAngle, degrees=True).as_matrix()
+        ryz = Rotation.from_euler('yz', [yAngle, zAngle], degrees=True).as_matrix()
+        pivot = np.array((self.meanX, 0.0, 0.0))
+
+        matrix = np.identity(4)
+        matrix[:3, :3] = ryz @ rx
+        matrix[:3, 3] = pivot - ryz @ pivot + (xOffset, yOffset, zOffset)
+        return matrix
+
+    def pose_from_matrix(self, matrix):
+        # Inverse of pose_matrix, Ryz @ Rx is an extrinsic xyz rotation
+        xAngle, yAngle, zAngle = Rotation.from_matrix(matrix[:3, :3]).as_euler('xyz', degrees=True)
+        ryz = Rotation.from_euler('yz', [yAngle, zAngle], degrees=True).as_matrix()
+        pivot = np.array((self.meanX, 0.0, 0.0))
+        xOffset, yOffset, zOffset = matrix[:3, 3] - pivot + ryz @ pivot
+        return float(xOffset), float(yOffset), float(zOffset), float(xAngle), float(yAngle), float(zAngle)
+
+    def transform(self, pose=None, out=None):
+        # Transformed points are written into a persistent float32 buffer, pyqtgraph uploads float32 anyway
+        if out is None:
+            if self.pointsArray is None or len(self.pointsArray) != self.imageArray.size:
+                self.pointsArray = np.empty((self.imageArray.size, 3), dtype=np.float32)
+            out = self.pointsArray
+
+        with timed(self.timings, "transform"):
+            return transform_grid(*self.grid(), self.pose_matrix(pose), out)
+
+
+def create_sensors(heads, denoise=None):
+    # Heads in panel order, highest number first. The first one is mirrored onto negative X and the others follow it
+    # one head width apart, which for the two-head line puts Sensor2 on the left and Sensor1 on the right
+    heads = sorted(heads, key=int, reverse=True)
+    return [Sensor(f"Sensor{head}", isOffset=index == 0, denoise=denoise, lane=max(0, index - 1))
+            for index, head in enumerate(heads)]
@@ -0,0 +1,143 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from Sensor import ColormapWorker, height_colormap, create_sensors
+from Pipeline import load_frames
+from Denoise import create_filter
+from Profiler import profiler
+from PairIndex import PairIndex
+
+
+def write_ply(path, pointsArray, colors=None):
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if colors is not None:
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+
+    vertices = np.empty(len(pointsArray), dtype=fields)
+    vertices['x'], vertices['y'], vertices['z'] = pointsArray.T
+    if colors is not None:
+        rgb = np.clip(colors[:, :3] * 255, 0, 255).astype(np.uint8)
+        vertices['red'], vertices['green'], vertices['blue'] = rgb.T
+
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {len(pointsArray)}"]
+    header += [f"property {'float' if dtype == '<f4' else 'uchar'} {name}" for name, dtype in fields]
+    header += ["end_header", ""]
+    with open(path, "wb") as file:
+        file.write("\n".join(header).encode("ascii"))
+        vertices.tofile(file)
+
+
+def convert_group(sensors, paths, output, fileFormat, withColors):
+    # Runs in a worker process, the sensors are pickled copies carrying their poses
+    frames = load_frames(sensors, paths, process3d=True)
+    clouds = []
+    timings = []
+    for sensor, frame in zip(sensors, frames):
+        sensor.load_frame(frame)
+        clouds.append(sensor.transform())
+        timings.append({**frame["timings"], **sensor.timings})
+    pointsArray = np.concatenate(clouds)
+
+    if fileFormat == "ply":
+        colors = None
+        if withColors:
+            colors = ColormapWorker.allocate(pointsArray)
+            height_colormap(pointsArray, colors)
+        write_ply(output, pointsArray, colors)
+    else:
+        np.save(output, pointsArray)
+    return len(pointsArray), timings
+
+
+def pose_argument(value):
+    pose = tuple(float(part) for part in value.split(","))
+    if len(pose) != 6:
+        raise argparse.ArgumentTypeError("pose has to be six comma separated numbers: x,y,z,angleX,angleY,angleZ")
+    return pose
+
+
+def panel_pose_argument(value):
+    panel, _, pose = value.partition("=")
+    if not panel.isdigit() or int(panel) < 1:
+        raise argparse.ArgumentTypeError("expected PANEL=X,Y,Z,AX,AY,AZ with the 1-based panel number of the GUI")
+    return int(panel), pose_argument(pose)
+
+
+def jobs_argument(value):
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError("number of worker processes has to be a positive integer")
+    return int(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts SensorK image groups to merged point clouds without the GUI")
+    parser.add_argument("folder", help="folder with SensorK_*.png images, any number of heads")
+    parser.add_argument("-o", "--output", help="output folder, defaults to <folder>/clouds")
+    parser.add_argument("-f", "--format", choices=("ply", "npy"), default="ply")
+    parser.add_argument("--colors", action="store_true", help="store the preview colormap in PLY files")
+    parser.add_argument("--sensor1", type=pose_argument, default=(0.0,) * 6, metavar="X,Y,Z,AX,AY,AZ",
+                        help="offsets [mm] and angles [°] of the \"Sensor 1 (Lewy)\" panel")
+    parser.add_argument("--sensor2", type=pose_argument, default=(0.0,) * 6, metavar="X,Y,Z,AX,AY,AZ",
+                        help="offsets [mm] and angles [°] of the \"Sensor 2 (Prawy)\" panel")
+    parser.add_argument("--pose", type=panel_pose_argument, action="append", default=[], metavar="PANEL=X,Y,Z,AX,AY,AZ",
+                        help="offsets and angles of any panel, panels are numbered like in the GUI (highest head first)")
+    parser.add_argument("-d", "--denoise", type=create_filter, default=None, metavar="KIND[:SIZE[:THREADS]]",
+                        help="median, separable or none, defaults to $PROFILEPREVIEWER_DENOISE or median:5")
+    parser.add_argument("-j", "--jobs", type=jobs_argument, default=os.cpu_count() or 1,
+                        help="number of worker processes")
+    args = parser.parse_args()
+
+    # A mistyped folder must not be created as an empty output tree
+    if not os.path.isdir(args.folder):
+        parser.error(f"{args.folder} is not a folder")
+
+    # Same sensor setup and file order as MainWidget
+    index = PairIndex()
+    suffixes = index.scan(args.folder)
+    sensors = create_sensors(index.sensors(), denoise=args.denoise)
+    poses = {1: args.sensor1, 2: args.sensor2, **dict(args.pose)}
+    for panel, _ in args.pose:
+        if panel > len(sensors):
+            print(f"Warning: --pose {panel}= ignored, {args.folder} has {len(sensors)} heads", file=sys.stderr)
+
+    output = args.output or os.path.join(args.folder, "clouds")
+    os.makedirs(output, exist_ok=True)
+    for panel, sensor in enumerate(sensors, 1):
+        sensor.xOffset, sensor.yOffset, sensor.zOffset, sensor.xAngle, sensor.yAngle, sensor.zAngle = \
+            poses.get(panel, (0.0,) * 6)
+
+    print(f"{len(suffixes)} groups of {len(sensors)} heads in {args.folder}, {args.jobs} processes, "
+          f"filter {sensors[0].denoise.name if sensors else '-'}")
+
+    start = time.perf_counter()
+    totalPoints = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for suffix in suffixes:
+            paths = [sensor.path(args.folder, suffix) for sensor in sensors]
+            target = os.path.join(output, f"Merged{os.path.splitext(suffix)[0]}.{args.format}")
+            futures[executor.submit(convert_group, sensors, paths, target, args.format, args.colors)] = suffix
+
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                points, timings = future.result()
+                totalPoints += points
+                for sensorTimings in timings:
+                    profiler.record_all(sensorTimings)
+            except (OSError, ValueError) as error:
+                failed += 1
+                print(f"{futures[future]}: {error}")
+            if done % 100 == 0:
+                print(f"{done}/{len(futures)} groups, {done / (time.perf_counter() - start):.1f} groups/s")
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(suffixes) - failed} groups, {totalPoints} points in {elapsed:.2f} s, "
+          f"{len(suffixes) / elapsed if elapsed > 0 else 0.0:.1f} groups/s")
+    if profiler.summary():
+        print("Stage times per sensor, p50/p95/max:\n  " + profiler.format("\n  "))
@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import PIL.Image
+
+import numpy as np
+from scipy.ndimage import median_filter
+from scipy.spatial.transform import Rotation
+
+from Denoise import create_filter
+from Registration import register
+from Sensor import Sensor, ColormapWorker, height_colormap, LutColormap
+
+TEST_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_files")
+
+
+def legacy_colormap(pointsArray):
+    # Per-point loop used by ColormapWorker before vectorization, kept as the reference
+    colors = np.empty((np.shape(pointsArray)[0], 4))
+    maxZ = np.max(pointsArray[:, 2])
+    maxY = np.max(pointsArray[:, 1])
+    norm = np.exp(0.04 * (pointsArray[:, 2] - maxZ))
+    normY = pointsArray[:, 1] / maxY
+    for i in range(np.shape(colors)[0]):
+        val = norm[i]
+        colors[i] = (1 - val, val, normY[i], 0.5)
+    return colors
+
+
+def legacy_transform(sensor):
+    # Separate rotation and offset passes used by Sensor.transform before the composed matrix
+    pointsArray = sensor.points().astype(np.float64)
+    pointsArray = Rotation.from_euler('x', sensor.xAngle, degrees=True).apply(pointsArray)
+    ryz = Rotation.from_euler('yz', [sensor.yAngle, sensor.zAngle], degrees=True)
+    meanX = np.mean(pointsArray[:, 0])
+    pointsArray[:, 0] = pointsArray[:, 0] - meanX
+    pointsArray = ryz.apply(pointsArray)
+    pointsArray[:, 0] = pointsArray[:, 0] + meanX
+    pointsArray[:, 0] += sensor.xOffset
+    pointsArray[:, 1] += sensor.yOffset
+    pointsArray[:, 2] += sensor.zOffset
+    return pointsArray
+
+
+def legacy_denoise(imageArray, maxVal, zStep=Sensor.zStep):
+    # Scaling to float64 first and filtering afterwards, the way Sensor.process_image2d used to
+    imageArray = imageArray.copy()
+    imageArray[imageArray == 0] = maxVal
+    return median_filter(imageArray * -zStep, size=5)
+
+
+def load_sensor(name="Sensor1_2021_06_24_11_26_32_0000.png"):
+    sensor = Sensor("Sensor1", isOffset=True)
+    sensor.open_image(os.path.join(TEST_FILES, name))
+    sensor.maxVal = np.max(sensor.imageArray)
+    sensor.process_image2d()
+    sensor.process_image3d()
+    sensor.transform()
+    return sensor
+
+
+def measure(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times), np.median(times)
+
+
+def bench_colormap(repeat):
+    pointsArray = load_sensor().pointsArray
+    buffer = ColormapWorker.allocate(pointsArray)
+    lut = LutColormap(np.linspace((0.0, 0.0, 1.0, 0.5), (1.0, 0.0, 0.0, 0.5), 256))
+
+    expected = legacy_colormap(pointsArray)
+    height_colormap(pointsArray, buffer)
+    assert np.allclose(expected, buffer, atol=1e-5), "Vectorized colormap differs from the reference"
+
+    print(f"Colormap, {np.shape(pointsArray)[0]} points per frame")
+    for name, function, runs in (("legacy loop", lambda: legacy_colormap(pointsArray), 1),
+                                 ("height_colormap", lambda: height_colormap(pointsArray, buffer), repeat),
+                                 ("LutColormap", lambda: lut(pointsArray, buffer), repeat)):
+        best, median = measure(function, runs)
+        print(f"  {name:<20} best {best * 1000:9.2f} ms   median {median * 1000:9.2f} ms")
+
+
+def bench_transform(repeat):
+    sensor = load_sensor()
+    sensor.xOffset, sensor.yOffset, sensor.zOffset = 12.5, -3.0, 1.5
+    sensor.xAngle, sensor.yAngle, sensor.zAngle = 2.0, -1.5, 30.0
+
+    expected = legacy_transform(sensor)
+    sensor.transform()
+    assert np.allclose(expected, sensor.pointsArray, atol=1e-3), "Composed transform differs from the reference"
+
+    print(f"Transform, {np.shape(sensor.pointsArray)[0]} points per frame")
+    for name, function in (("legacy passes", lambda: legacy_transform(sensor)),
+                           ("Sensor.transform", sensor.transform)):
+        best, median = measure(function, repeat)
+        print(f"  {name:<20} best {best * 1000:9.2f} ms   median {median * 1000:9.2f} ms")
+
+
+def bench_registration(repeat):
+    # The same frame on both heads with a known pose on the second one, registration has to undo all of it but the
+    # travel offset, which it leaves as it was
+    fixed, moving = load_sensor(), load_sensor()
+    perturbation = (4.0, -3.0, 2.0, 1.0, -1.5, 2.0)
+
+    def run():
+        moving.xOffset, moving.yOffset, moving.zOffset, moving.xAngle, moving.yAngle, moving.zAngle = perturbation
+        return register([fixed], [moving])
+
+    pose, rms, iterations = run()
+    assert np.allclose(pose, (0.0, perturbation[1], 0.0, 0.0, 0.0, 0.0), atol=1e-4), \
+        f"Registration did not recover the known pose, got {np.round(pose, 5)}"
+
+    print(f"Registration, {np.shape(fixed.pointsArray)[0]} points per head, RMS {rms:.1e} mm in {iterations} iterations")
+    best, median = measure(run, repeat)
+    print(f"  {'register':<20} best {best * 1000:9.2f} ms   median {median * 1000:9.2f} ms")
+
+
+def bench_denoise(repeat, threads):
+    sensor = Sensor("Sensor1")
+    images = []
+    for name in sorted(os.listdir(TEST_FILES)):
+        if name.endswith(".png"):
+            sensor.open_image(os.path.join(TEST_FILES, name))
+            images.append(sensor.imageArray)
+    maxVal = max(np.max(image) for image in images)
+
+    def run(denoise):
+        for image in images:
+            sensor.imageArray, sensor.maxVal, sensor.denoise = image.copy(), maxVal, denoise
+            sensor.process_image2d()
+        return sensor.imageArray
+
+    reference = legacy_denoise(images[-1], maxVal)
+    assert np.allclose(reference, run(create_filter("median:5")), atol=1e-4), "uint16 median differs from the reference"
+
+    print(f"Denoising, {len(images)} images of {np.shape(images[0])[0]}x{np.shape(images[0])[1]} from test_files")
+    best, median = measure(lambda: [legacy_denoise(image, maxVal) for image in images], repeat)
+    print(f"  {'legacy float64':<20} best {best * 1000:9.2f} ms   median {median * 1000:9.2f} ms")
+    for spec in ("median:5", f"median:5:{threads}", "median:3", f"median:3:{threads}",
+                 "separable:5", f"separable:5:{threads}", "none"):
+        denoise = create_filter(spec)
+        best, median = measure(lambda: run(denoise), repeat)
+        print(f"  {spec:<20} best {best * 1000:9.2f} ms   median {median * 1000:9.2f} ms")
+
+
+def synthetic_frame(folder, scale, name="Sensor1_2021_06_24_11_26_32_0000.png"):
+    # Bundled frame upscaled by pixel repetition, with a little seeded noise so the filter does not see flat blocks
+    image = np.array(PIL.Image.open(os.path.join(TEST_FILES, name)))
+    image = np.repeat(np.repeat(image, scale, axis=0), scale, axis=1)
+    noise = np.random.default_rng(scale).integers(0, 3, image.shape, dtype=np.uint16)
+    image = np.where(image > 0, image + noise, 0).astype(np.uint16)
+
+    path = os.path.join(folder, f"Sensor1_x{scale}.png")
+    PIL.Image.fromarray(image).save(path)
+    return path
+
+
+def profile_stages(path, repeat):
+    # Same order of calls as a frame shown in the 3D view, every stage timed on its own
+    sensor = Sensor("Sensor1", isOffset=True)
+    worker = ColormapWorker(None)
+
+    def process_image2d():
+        sensor.maxVal = np.max(sensor.imageArray)
+        sensor.process_image2d()
+
+    def generate_colormap():
+        worker.pointsArray = sensor.pointsArray
+        worker.generate_colormap()
+
+    stages = (("open_image", lambda: sensor.open_image(path)), ("process_image2d", process_image2d),
+              ("process_image3d", sensor.process_image3d), ("transform", sensor.transform),
+              ("generate_colormap", generate_colormap))
+
+    times = {name: [] for name, _ in stages}
+    for _ in range(repeat):
+        for name, function in stages:
+            start = time.perf_counter()
+            function()
+            times[name].append(time.perf_counter() - start)
+
+    # Separate pass for memory, tracemalloc slows allocations down too much to time with it
+    peaks = {}
+    tracemalloc.start()
+    for name, function in stages:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        function()
+        peaks[name] = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    return sensor.imageArray.shape, {name: {"best_ms": min(times[name]) * 1000,
+                                            "median_ms": float(np.median(times[name])) * 1000,
+                                            "peak_mb": peaks[name] / 2 ** 20} for name, _ in stages}
+
+
+def bench_stages(repeat, scales):
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        frames = [os.path.join(TEST_FILES, "Sensor1_2021_06_24_11_26_32_0000.png")]
+        frames += [synthetic_frame(folder, scale) for scale in scales if scale > 1]
+        for path in frames:
+            shape, stages = profile_stages(path, repeat)
+            label = f"{shape[0]}x{shape[1]}"
+            results[label] = stages
+
+            print(f"Stages, {label} frame{'' if path.startswith(TEST_FILES) else ' (synthetic)'}")
+            for name, result in stages.items():
+                print(f"  {name:<20} best {result['best_ms']:9.2f} ms   median {result['median_ms']:9.2f} ms"
+                      f"   peak {result['peak_mb']:8.1f} MB")
+    return results
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+            "processor": platform.processor(), "cpus": os.cpu_count(), "filter": Sensor("Sensor1").denoise.name}
+
+
+def compare(results, baseline, tolerance):
+    # Best time and peak memory against a stored run, returns the regressions found. The best of several runs is far
+    # less sensitive to other load on the machine than the median
+    regressions = []
+    print(f"Compared to the baseline, tolerance {tolerance:.0%}")
+    for label, stages in results.items():
+        for name, result in stages.items():
+            reference = baseline.get(label, {}).get(name)
+            if reference is None:
+                continue
+            ratio = result["best_ms"] / reference["best_ms"] if reference["best_ms"] > 0 else 1.0
+            memory = result["peak_mb"] - reference["peak_mb"]
+            slower = ratio > 1 + tolerance
+            larger = memory > max(1.0, reference["peak_mb"] * tolerance)
+            flag = "  REGRESSION" if slower or larger else ""
+            print(f"  {label:<10} {name:<20} time x{ratio:5.2f}   memory {memory:+8.1f} MB{flag}")
+            if flag:
+                regressions.append((label, name))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ProfilePreviewer processing benchmarks")
+    parser.add_argument("-r", "--repeat", type=int, default=20, help="number of timed runs per stage")
+    parser.add_argument("-t", "--threads", type=int, default=os.cpu_count() or 1, help="row bands for the tiled filters")
+    parser.add_argument("-s", "--scales", type=lambda value: [int(part) for part in value.split(",")], default=[1, 2, 4],
+                        help="comma separated upscaling factors of the synthetic frames, 1 is the bundled frame only")
+    parser.add_argument("--stages-only", action="store_true", help="skip the comparisons with the legacy implementations")
+    parser.add_argument("--save", metavar="PATH", help="store the stage results as a JSON baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare the stage results with a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown against the baseline")
+    args = parser.parse_args()
+
+    if not args.stages_only:
+        bench_colormap(args.repeat)
+        bench_transform(args.repeat)
+        bench_registration(args.repeat)
+        bench_denoise(args.repeat, args.threads)
+
+    results = bench_stages(args.repeat, args.scales)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"environment": environment(), "repeat": args.repeat, "stages": results}, file, indent=2)
+        print(f"Baseline saved to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            stored = json.load(file)
+        if stored.get("environment") != environment():
+            print(f"Baseline recorded on a different setup: {stored.get('environment')}")
+        if compare(results, stored["stages"], args.tolerance):
+            sys.exit(1)
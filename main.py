@@ -1,22 +1,26 @@
-import re
 import sys
 import os
-from PyQt5.QtCore import Qt, pyqtSignal, QThread, QModelIndex
+from PyQt5.QtCore import Qt, pyqtSignal, QModelIndex, QTimer
 from PyQt5.QtWidgets import QWidget, QLabel, QVBoxLayout, QApplication, QHBoxLayout, QGroupBox, \
-    QFormLayout, QPushButton, QTabWidget, QDoubleSpinBox, QMainWindow, QToolBar, QLineEdit, QFileDialog, QListWidget, \
-    QListView, QCheckBox, QErrorMessage
+    QFormLayout, QPushButton, QTabWidget, QDoubleSpinBox, QMainWindow, QToolBar, QLineEdit, QFileDialog, QListView, \
+    QCheckBox, QErrorMessage, QScrollArea, QMessageBox
 from pyqtgraph import ImageView
 from pyqtgraph import opengl as gl
 import numpy as np
-from Sensor import Sensor, ColormapWorker
+from Sensor import height_colormap, generate_colors, grid_colors, create_sensors
+from FrameCache import FrameCache, SidecarCache
+from Pipeline import create_executor, Prefetcher, FrameLoader, JobScheduler
+from PairIndex import PairIndex, PairIngest, PairListModel
+from Rendering import LodScatter, InteractionMonitor, HeightMapSurface, ProfiledGLView, RollingVolume, \
+    pose_transform
+from Profiler import profiler
+from Registration import register_all, RegistrationCache
 from watchdog.observers import Observer
 from watchdog.events import RegexMatchingEventHandler
 
 
 class MainWindow(QMainWindow):
-
-    ready = pyqtSignal(str, str)
-    pattern = re.compile('[0-9_]+\\.png')
+    PROFILER_MS = 1000
 
     def __init__(self):
         super().__init__()
@@ -33,32 +37,54 @@ class MainWindow(QMainWindow):
         self.pathButton.clicked.connect(self.choose_folder)
 
         self.mainWidget = MainWidget()
-        self.mainWidget.fileList.itemSelectionChanged.connect(self.selection_changed)
+        self.mainWidget.fileList.selectionModel().currentChanged.connect(self.selection_changed)
         self.mainWidget.refreshRequired.connect(self.update_file_list)
 
+        # New files are paired in memory on the watchdog thread and handed to the GUI in batches
+        self.pairIndex = PairIndex()
+        self.pairIngest = PairIngest(self.pairIndex)
+        self.pairIngest.paired.connect(self.add_pairs)
+        self.pairIngest.unpaired.connect(self.mainWidget.fileModel.remove)
+        self.pairIngest.overflowed.connect(self.update_file_list)
+
         self.observer = Observer()
         self.observer.start()
-        self.eventHandler = RegexMatchingEventHandler([".+Sensor[12][0-9_]+\\.png$"], None, True, False)
-        self.eventHandler.on_created = self.on_created
+        self.eventHandler = RegexMatchingEventHandler([".+Sensor[0-9]+_[0-9_]*\\.png$"], None, True, False)
+        self.eventHandler.on_created = self.pairIngest.on_created
+        self.eventHandler.on_deleted = self.pairIngest.on_deleted
 
         self.setCentralWidget(self.mainWidget)
-        self.ready.connect(self.mainWidget.update_image_view)
 
         self.autoSwitchCheckbox = QCheckBox("Automatycznie wyświetlaj nowe obrazy")
 
+        # Rolling p50/p95/max of every processing stage, shown in the status bar on demand
+        self.profilerCheckbox = QCheckBox("Czasy etapów")
+        self.profilerCheckbox.toggled.connect(self.profiler_toggled)
+        self.profilerButton = QPushButton("Zapisz czasy")
+        self.profilerButton.clicked.connect(self.save_timings)
+        self.profilerLabel = QLabel()
+        self.statusBar().addWidget(self.profilerLabel)
+        self.statusBar().setVisible(False)
+        self.profilerTimer = QTimer(self)
+        self.profilerTimer.setInterval(self.PROFILER_MS)
+        self.profilerTimer.timeout.connect(self.update_timings)
+
         tb = QToolBar()
         tb.layout().setSpacing(10)
         tb.addWidget(self.pathEdit)
         tb.addWidget(self.pathButton)
         tb.addWidget(self.autoSwitchCheckbox)
+        tb.addWidget(self.profilerCheckbox)
+        tb.addWidget(self.profilerButton)
         self.addToolBar(tb)
         self.showMaximized()
 
         self.update_file_list()
+        self.mainWidget.load_registration(self.pathEdit.text())
 
-        if self.mainWidget.fileList.item(0).text().endswith(".png"):
-            self.mainWidget.fileList.setCurrentRow(0)
-            self.mainWidget.update_image_view(f"{self.pathEdit.text()}\\Sensor2{self.mainWidget.fileList.item(0).text()}", f"{self.pathEdit.text()}\\Sensor1{self.mainWidget.fileList.item(0).text()}")
+        # Selecting the first pair also loads it through selection_changed
+        if self.mainWidget.fileModel.count() > 0:
+            self.select_row(0)
 
     def choose_folder(self):
         folderPath = str(QFileDialog.getExistingDirectory(self, "Wybierz folder do obserwowania", directory=self.pathEdit.text()))
@@ -68,193 +94,251 @@ class MainWindow(QMainWindow):
                 self.pathEdit.setText(folderPath)
                 self.observer.schedule(self.eventHandler, folderPath, recursive=False)
                 self.update_file_list()
+                self.mainWidget.load_registration(folderPath)
             else:
                 self.pathEdit.setText("Brak uprawnień do folderu")
 
-    def on_created(self, event):
-        suffix = self.pattern.search(event.src_path)[0]
-        fileList = os.listdir(self.pathEdit.text())
-
-        if suffix.startswith('1'):
-            firstFileName = "Sensor" + suffix
-            secondFileName = "Sensor2" + suffix[1:len(suffix)]
+    def closeEvent(self, event):
+        self.mainWidget.stop_workers()
+        # Operator machines can keep a log of the stage times of every session
+        logPath = os.environ.get("PROFILEPREVIEWER_PROFILE_LOG")
+        if logPath:
+            try:
+                profiler.dump(logPath)
+            except OSError:
+                pass
+        super().closeEvent(event)
+
+    def profiler_toggled(self, checked):
+        self.statusBar().setVisible(checked)
+        if checked:
+            self.update_timings()
+            self.profilerTimer.start()
         else:
-            firstFileName = "Sensor1" + suffix[1:len(suffix)]
-            secondFileName = "Sensor" + suffix
+            self.profilerTimer.stop()
 
-        if firstFileName in fileList and secondFileName in fileList:
-            if self.mainWidget.fileList.item(0).text().startswith("Brak"):
-                self.mainWidget.fileList.clear()
-            self.mainWidget.fileList.addItem(firstFileName.replace("Sensor1", ""))
-            if self.autoSwitchCheckbox.isChecked():
-                self.mainWidget.fileList.setCurrentRow(self.mainWidget.fileList.count()-1)
-                self.ready.emit(self.pathEdit.text() + f"/{secondFileName}", self.pathEdit.text() + f"/{firstFileName}")
+    def update_timings(self):
+        self.profilerLabel.setText(profiler.format() or "Brak pomiarów")
 
-    def update_file_list(self):
-        # Clear the list of old items
-        self.mainWidget.fileList.itemSelectionChanged.disconnect()
-        self.mainWidget.fileList.clear()
+    def save_timings(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Zapisz czasy etapów", self.pathEdit.text(),
+                                              "CSV (*.csv);;JSON (*.json)")
+        if len(path) != 0:
+            try:
+                profiler.dump(path)
+            except OSError as error:
+                QErrorMessage(self).showMessage(str(error))
 
-        # List files in path and those that begin with Sensor1
-        files = [file for file in os.listdir(self.pathEdit.text()) if re.match(r"^Sensor[12][_0-9]+.png$", file)]
-        onlyS1 = [file for file in files if re.match(r"^Sensor1[_0-9]+.png$", file)]
+    def add_pairs(self, suffixes):
+        self.mainWidget.fileModel.insert(suffixes)
 
-        for file in onlyS1:
-            secondFileName = file.replace("Sensor1", "Sensor2")
-            # If a proper pair exists, add only the suffix to the list
-            if secondFileName in files:
-                self.mainWidget.fileList.addItem(file.replace("Sensor1", ""))
+        # Only the newest pair of a batch is displayed, the ones in between are skipped
+        if self.autoSwitchCheckbox.isChecked():
+            self.select_row(self.mainWidget.fileModel.row(max(suffixes)))
 
-        # If there are no proper pairs of images in the folder, add single item informing the user of that
-        if self.mainWidget.fileList.count() == 0:
-            self.mainWidget.fileList.addItem("Brak plików w folderze!")
-        self.mainWidget.fileList.itemSelectionChanged.connect(self.selection_changed)
+    def update_file_list(self):
+        # One pass over the folder, the model is reset with the complete groups only
+        try:
+            suffixes = self.pairIndex.scan(self.pathEdit.text())
+        except OSError:
+            suffixes = []
+        self.mainWidget.set_heads(self.pairIndex.sensors())
+        self.mainWidget.fileModel.set_suffixes(suffixes)
+
+    def select_row(self, row):
+        self.mainWidget.fileList.setCurrentIndex(self.mainWidget.fileModel.index(row))
 
     def selection_changed(self):
-        if self.mainWidget.fileList.currentItem().text().endswith(".png"):
-            self.mainWidget.update_image_view(f"{self.pathEdit.text()}/Sensor2{self.mainWidget.fileList.currentItem().text()}",
-                                              f"{self.pathEdit.text()}/Sensor1{self.mainWidget.fileList.currentItem().text()}")
+        suffix = self.mainWidget.fileModel.suffix(self.mainWidget.fileList.currentIndex().row())
+        if suffix is not None:
+            self.mainWidget.update_image_view(self.mainWidget.paths(self.pathEdit.text(), suffix))
+            self.prefetch_neighbours()
+
+    def prefetch_neighbours(self):
+        # Next and previous pairs around the selection, nearest first
+        row = self.mainWidget.fileList.currentIndex().row()
+        pairs = []
+        for distance in range(1, self.mainWidget.PREFETCH_RADIUS + 1):
+            for neighbour in (row + distance, row - distance):
+                if 0 <= neighbour < self.mainWidget.fileModel.count():
+                    pairs.append(self.mainWidget.paths(self.pathEdit.text(), self.mainWidget.fileModel.suffix(neighbour)))
+        self.mainWidget.prefetcher.update(pairs, self.mainWidget.tabs.currentIndex() == 1)
+
+
+class SensorPanel(QGroupBox):
+    COLUMN_WIDTH = 250
+
+    changed = pyqtSignal()
+    applyClicked = pyqtSignal()
+
+    def __init__(self, title):
+        super().__init__(title)
+
+        self.xOffsetSpinbox = self.create_spinbox(1000, " mm")
+        self.yOffsetSpinbox = self.create_spinbox(1000, " mm")
+        self.zOffsetSpinbox = self.create_spinbox(1000, " mm")
+        self.xAngleSpinbox = self.create_spinbox(180, " °")
+        self.yAngleSpinbox = self.create_spinbox(180, " °")
+        self.zAngleSpinbox = self.create_spinbox(180, " °")
+
+        self.resetButton = QPushButton("Reset")
+        self.resetButton.clicked.connect(self.reset)
+        self.applyButton = QPushButton("Zastosuj")
+        self.applyButton.clicked.connect(self.applyClicked)
+        self.applyButton.setEnabled(False)
+
+        layout = QFormLayout()
+        layout.addRow(QLabel("X"), self.xOffsetSpinbox)
+        layout.addRow(QLabel("Y"), self.yOffsetSpinbox)
+        layout.addRow(QLabel("Z"), self.zOffsetSpinbox)
+
+        layout.addRow(QLabel("Kąt X"), self.xAngleSpinbox)
+        layout.addRow(QLabel("Kąt Y"), self.yAngleSpinbox)
+        layout.addRow(QLabel("Kąt Z"), self.zAngleSpinbox)
+        layout.addRow(self.resetButton, self.applyButton)
+
+        self.setLayout(layout)
+        self.setMaximumSize(self.COLUMN_WIDTH, 300)
+        self.setMinimumHeight(self.sizeHint().height())
+
+    def create_spinbox(self, limit, suffix):
+        spinbox = QDoubleSpinBox()
+        spinbox.setRange(-limit, limit)
+        spinbox.setSuffix(suffix)
+        spinbox.valueChanged.connect(self.changed)
+        return spinbox
+
+    def spinboxes(self):
+        return (self.xOffsetSpinbox, self.yOffsetSpinbox, self.zOffsetSpinbox,
+                self.xAngleSpinbox, self.yAngleSpinbox, self.zAngleSpinbox)
+
+    def pose(self):
+        return tuple(spinbox.value() for spinbox in self.spinboxes())
+
+    def set_pose(self, pose):
+        for spinbox, value in zip(self.spinboxes(), pose):
+            spinbox.setValue(value)
+
+    def reset(self):
+        self.set_pose((0.0,) * 6)
 
 
 class MainWidget(QWidget):
     SCALE = 0.5
     POINT_SIZE = 0.1
     Y_STEP = 1
+    FRAME_CACHE_MB = 512
+    PREFETCH_RADIUS = 3
+    POINT_BUDGET = 50000
+    IDLE_MS = 250
+    COLORMAP_WORKERS = 2
+    STACK_FRAMES = 10
+    # Frames fitted together by the registration, the shown one and cached neighbours
+    REGISTRATION_FRAMES = 4
+    # Every point of a stacked frame is kept, a larger stride decimates the ring to save GPU memory
+    STACK_STRIDE = 1
+    # Heads assumed while the folder has no images yet
+    DEFAULT_HEADS = ("1", "2")
 
     refreshRequired = pyqtSignal()
 
     def __init__(self):
         super().__init__()
 
-        self.sensor1XOffsetSpinbox = QDoubleSpinBox()
-        self.sensor1XOffsetSpinbox.setRange(-1000, 1000)
-        self.sensor1XOffsetSpinbox.setSuffix(" mm")
-        self.sensor1XOffsetSpinbox.valueChanged.connect(self.update_sensor1_values)
-
-        self.sensor1YOffsetSpinbox = QDoubleSpinBox()
-        self.sensor1YOffsetSpinbox.setRange(-1000, 1000)
-        self.sensor1YOffsetSpinbox.setSuffix(" mm")
-        self.sensor1YOffsetSpinbox.valueChanged.connect(self.update_sensor1_values)
-
-        self.sensor1ZOffsetSpinbox = QDoubleSpinBox()
-        self.sensor1ZOffsetSpinbox.setRange(-1000, 1000)
-        self.sensor1ZOffsetSpinbox.setSuffix(" mm")
-        self.sensor1ZOffsetSpinbox.valueChanged.connect(self.update_sensor1_values)
-
-        self.sensor1XAngleSpinbox = QDoubleSpinBox()
-        self.sensor1XAngleSpinbox.setRange(-180, 180)
-        self.sensor1XAngleSpinbox.setSuffix(" °")
-        self.sensor1XAngleSpinbox.valueChanged.connect(self.update_sensor1_values)
-
-        self.sensor1YAngleSpinbox = QDoubleSpinBox()
-        self.sensor1YAngleSpinbox.setRange(-180, 180)
-        self.sensor1YAngleSpinbox.setSuffix(" °")
-        self.sensor1YAngleSpinbox.valueChanged.connect(self.update_sensor1_values)
-
-        self.sensor1ZAngleSpinbox = QDoubleSpinBox()
-        self.sensor1ZAngleSpinbox.setRange(-180, 180)
-        self.sensor1ZAngleSpinbox.setSuffix(" °")
-        self.sensor1ZAngleSpinbox.valueChanged.connect(self.update_sensor1_values)
-
-        self.sensor1ResetButton = QPushButton("Reset")
-        self.sensor1ResetButton.clicked.connect(self.reset_sensor1_values)
-        self.sensor1ApplyButton = QPushButton("Zastosuj")
-        self.sensor1ApplyButton.clicked.connect(self.apply_sensor1_values)
-        self.sensor1ApplyButton.setEnabled(False)
-
-        self.sensor2XOffsetSpinbox = QDoubleSpinBox()
-        self.sensor2XOffsetSpinbox.setRange(-1000, 1000)
-        self.sensor2XOffsetSpinbox.setSuffix(" mm")
-        self.sensor2XOffsetSpinbox.valueChanged.connect(self.update_sensor2_values)
-
-        self.sensor2YOffsetSpinbox = QDoubleSpinBox()
-        self.sensor2YOffsetSpinbox.setRange(-1000, 1000)
-        self.sensor2YOffsetSpinbox.setSuffix(" mm")
-        self.sensor2YOffsetSpinbox.valueChanged.connect(self.update_sensor2_values)
-
-        self.sensor2ZOffsetSpinbox = QDoubleSpinBox()
-        self.sensor2ZOffsetSpinbox.setRange(-1000, 1000)
-        self.sensor2ZOffsetSpinbox.setSuffix(" mm")
-        self.sensor2ZOffsetSpinbox.valueChanged.connect(self.update_sensor2_values)
-
-        self.sensor2XAngleSpinbox = QDoubleSpinBox()
-        self.sensor2XAngleSpinbox.setRange(-180, 180)
-        self.sensor2XAngleSpinbox.setSuffix(" °")
-        self.sensor2XAngleSpinbox.valueChanged.connect(self.update_sensor2_values)
-
-        self.sensor2YAngleSpinbox = QDoubleSpinBox()
-        self.sensor2YAngleSpinbox.setRange(-180, 180)
-        self.sensor2YAngleSpinbox.setSuffix(" °")
-        self.sensor2YAngleSpinbox.valueChanged.connect(self.update_sensor2_values)
-
-        self.sensor2ZAngleSpinbox = QDoubleSpinBox()
-        self.sensor2ZAngleSpinbox.setRange(-180, 180)
-        self.sensor2ZAngleSpinbox.setSuffix(" °")
-        self.sensor2ZAngleSpinbox.valueChanged.connect(self.update_sensor2_values)
-
-        self.sensor2ResetButton = QPushButton("Reset")
-        self.sensor2ResetButton.clicked.connect(self.reset_sensor2_values)
-        self.sensor2ApplyButton = QPushButton("Zastosuj")
-        self.sensor2ApplyButton.clicked.connect(self.apply_sensor2_values)
-        self.sensor2ApplyButton.setEnabled(False)
-
-        self.fileList = QListWidget()
+        self.fileModel = PairListModel("Brak plików w folderze!")
+        self.fileList = QListView()
+        self.fileList.setModel(self.fileModel)
+        self.fileList.setUniformItemSizes(True)
 
         self.tabs = QTabWidget()
 
         self.imageView = ImageView()
         self.imageView.setPredefinedGradient('viridis')
-        self.hostView = gl.GLViewWidget()
-        self.view1 = gl.GLScatterPlotItem(size=self.POINT_SIZE, pxMode=False)
-        self.view2 = gl.GLScatterPlotItem(size=self.POINT_SIZE, pxMode=False)
-
-        self.s1 = Sensor("Sensor1", isOffset=True)
-        self.s2 = Sensor("Sensor2")
+        self.hostView = ProfiledGLView()
+        self.cameraMonitor = InteractionMonitor(self.hostView, self.IDLE_MS)
+        self.cameraMonitor.moving.connect(lambda: self.set_coarse(True))
+        self.cameraMonitor.idle.connect(lambda: self.set_coarse(False))
+
+        # Everything per head is kept in parallel lists in panel order, rebuilt by set_heads when the heads change
+        self.heads = ()
+        self.sensors = []
+        self.panels = []
+        # Scatter items show coarse levels while the camera moves, full resolution once idle
+        self.views = []
+        self.lods = []
+        # Alternative rendering as a height map, uploaded once per frame and posed through its model matrix
+        self.surfaces = []
+        self.pointsKeys = []
+        # Second RGBA buffer per head, colormap jobs alternate between it and the one shown
+        self.spareColors = []
+        self.surfaceKey = None
+        self.surfaceCheckbox = QCheckBox("Powierzchnia zamiast punktów")
+        self.surfaceCheckbox.toggled.connect(self.surface_mode_toggled)
+
+        # Consecutive frames stitched along the travel axis, a ring of the last STACK_FRAMES per head
+        self.volumes = []
+        self.stackKey = None
+        self.stackRow = None
+        self.stackPosition = 0
+        self.stackCheckbox = QCheckBox("Łącz kolejne klatki")
+        self.stackCheckbox.toggled.connect(self.stack_mode_toggled)
+
+        self.frameCache = FrameCache(self.FRAME_CACHE_MB * 1024 * 1024)
+        self.frameKey = None
+        self.framePaths = None
+        self.executor = create_executor()
+        # Filtered grids are also kept on disk next to the images, reopening a folder maps them instead of decoding
+        self.sidecarCache = SidecarCache()
+        self.prefetcher = Prefetcher(self.frameCache, [], self.executor, self.sidecarCache)
+        self.frameLoader = FrameLoader(self.frameCache, [], self.executor, self.prefetcher, self.sidecarCache)
+        self.frameLoader.loaded.connect(self.show_frames)
+        self.frameLoader.failed.connect(self.show_load_error)
+
+        # Colormaps run on a fixed pool with one slot per head, only the newest job of a slot reaches the view
+        self.scheduler = JobScheduler(self.COLORMAP_WORKERS)
+        self.scheduler.failed.connect(self.show_error)
+
+        self.livePreviewCheckbox = QCheckBox("Podgląd na żywo")
+
+        # Neighbouring heads aligned on the shown frame, the poses are kept per folder and reused for every frame
+        self.registrationCache = RegistrationCache()
+        self.registerButton = QPushButton("Dopasuj automatycznie")
+        self.registerButton.clicked.connect(self.register_sensors)
+        self.registerButton.setEnabled(False)
+
+        self.panelLayout = QVBoxLayout()
+        self.panelLayout.setContentsMargins(0, 0, 0, 0)
 
         masterLayout = QHBoxLayout()
         masterLayout.addLayout(self.create_left_column())
         masterLayout.addWidget(self.create_image_view())
         self.setLayout(masterLayout)
 
+        self.set_heads(self.DEFAULT_HEADS)
+
     def create_left_column(self):
         COLUMN_WIDTH = 250
 
         masterLayout = QVBoxLayout()
-        groupR = QGroupBox("Sensor 1 (Lewy)")
 
-        layout = QFormLayout()
-        layout.addRow(QLabel("X"), self.sensor1XOffsetSpinbox)
-        layout.addRow(QLabel("Y"), self.sensor1YOffsetSpinbox)
-        layout.addRow(QLabel("Z"), self.sensor1ZOffsetSpinbox)
-
-        layout.addRow(QLabel("Kąt X"), self.sensor1XAngleSpinbox)
-        layout.addRow(QLabel("Kąt Y"), self.sensor1YAngleSpinbox)
-        layout.addRow(QLabel("Kąt Z"), self.sensor1ZAngleSpinbox)
-        layout.addRow(self.sensor1ResetButton, self.sensor1ApplyButton)
-
-        groupR.setLayout(layout)
-        groupR.setMaximumSize(COLUMN_WIDTH, 300)
-        masterLayout.addWidget(groupR, alignment=Qt.AlignTop)
-
-        groupL = QGroupBox("Sensor 2 (Prawy)")
-
-        layout = QFormLayout()
-        layout.addRow(QLabel("X"), self.sensor2XOffsetSpinbox)
-        layout.addRow(QLabel("Y"), self.sensor2YOffsetSpinbox)
-        layout.addRow(QLabel("Z"), self.sensor2ZOffsetSpinbox)
-
-        layout.addRow(QLabel("Kąt X"), self.sensor2XAngleSpinbox)
-        layout.addRow(QLabel("Kąt Y"), self.sensor2YAngleSpinbox)
-        layout.addRow(QLabel("Kąt Z"), self.sensor2ZAngleSpinbox)
-        layout.addRow(self.sensor2ResetButton, self.sensor2ApplyButton)
-
-        groupL.setLayout(layout)
-        groupL.setMaximumSize(COLUMN_WIDTH, 300)
-        masterLayout.addWidget(groupL, alignment=Qt.AlignTop)
+        # One panel per head, scrolled once there are more heads than fit next to the view
+        panels = QWidget()
+        panels.setLayout(self.panelLayout)
+        self.panelScroll = QScrollArea()
+        self.panelScroll.setWidget(panels)
+        self.panelScroll.setWidgetResizable(True)
+        self.panelScroll.setFrameShape(QScrollArea.NoFrame)
+        self.panelScroll.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.panelScroll.setMaximumWidth(COLUMN_WIDTH + 20)
+        masterLayout.addWidget(self.panelScroll)
 
         groupCam = QGroupBox("Sterowanie widokiem 3D")
 
         layout = QVBoxLayout()
+        layout.addWidget(self.livePreviewCheckbox)
+        layout.addWidget(self.surfaceCheckbox)
+        layout.addWidget(self.stackCheckbox)
+        layout.addWidget(self.registerButton)
         layout.addWidget(QLabel("<b> Lewy p/m</b> - obrót"))
         layout.addWidget(QLabel("<b> Środkowy p/m</b> - przesunięcie X/Y"))
         layout.addWidget(QLabel("<b> Ctrl + Lewy p/m</b> - przesunięcie Z"))
@@ -276,161 +360,353 @@ class MainWidget(QWidget):
         groupList.setMaximumWidth(COLUMN_WIDTH)
         masterLayout.addWidget(groupList, alignment=Qt.AlignTop)
 
-        masterLayout.setStretch(3, 100)
+        masterLayout.setStretch(2, 100)
 
         return masterLayout
 
     def create_image_view(self):
-        layout = QVBoxLayout()
-        layout.addWidget(self.imageView)
-
         self.tabs.addTab(self.imageView, "Widok 2D")
 
         # 3D Tab
-        layout = QVBoxLayout()
-
-        self.view1.setGLOptions('opaque')
-        self.view1.scale(self.SCALE, self.SCALE, self.SCALE)
-        self.hostView.addItem(self.view1)
-
-        self.view2.setGLOptions('opaque')
-        self.view2.scale(self.SCALE, self.SCALE, self.SCALE)
-        self.hostView.addItem(self.view2)
-
         self.hostView.pan(dx=0, dy=100 * self.Y_STEP * self.SCALE, dz=0)
         self.hostView.orbit(225, 180)
 
-        layout.addWidget(self.hostView)
         self.tabs.addTab(self.hostView, "Widok 3D")
 
         self.tabs.currentChanged.connect(self.tab_change_handler)
 
         return self.tabs
 
+    def set_heads(self, heads):
+        heads = tuple(sorted(heads or self.DEFAULT_HEADS, key=int, reverse=True))
+        if heads == self.heads:
+            return
+        self.heads = heads
+
+        # Drop everything of the previous layout, poses are kept for heads that are still present
+        poses = {sensor.prefix: sensor.pose() for sensor in self.sensors}
+        for index, panel in enumerate(self.panels):
+            self.scheduler.cancel(("points", index))
+            self.scheduler.cancel(("surface", index))
+            panel.deleteLater()
+        while self.panelLayout.count():
+            self.panelLayout.takeAt(0)
+        for view in self.views:
+            self.hostView.removeItem(view)
+        for surface in self.surfaces:
+            surface.remove()
+        for volume in self.volumes:
+            volume.remove()
+
+        self.sensors = create_sensors(heads)
+        self.panels, self.views, self.lods, self.surfaces, self.volumes = [], [], [], [], []
+        for index, sensor in enumerate(self.sensors):
+            panel = SensorPanel(self.panel_title(index, sensor))
+            panel.changed.connect(lambda index=index: self.update_sensor_values(index))
+            panel.applyClicked.connect(lambda index=index: self.apply_sensor_values(index))
+            panel.applyButton.setEnabled(self.tabs.currentIndex() == 1)
+            self.panelLayout.addWidget(panel, alignment=Qt.AlignTop)
+            self.panels.append(panel)
+            panel.set_pose(poses.get(sensor.prefix, sensor.pose()))
+
+            view = gl.GLScatterPlotItem(size=self.POINT_SIZE, pxMode=False)
+            view.setGLOptions('opaque')
+            view.scale(self.SCALE, self.SCALE, self.SCALE)
+            self.hostView.addItem(view)
+            self.views.append(view)
+            self.lods.append(LodScatter(view, self.POINT_BUDGET))
+
+            self.surfaces.append(HeightMapSurface(self.hostView, self.SCALE))
+            self.volumes.append(RollingVolume(self.hostView, self.STACK_FRAMES, self.SCALE, self.POINT_SIZE,
+                                              self.STACK_STRIDE))
+        self.panelLayout.addStretch()
+        # Up to two panels are shown whole, like the fixed left column before, more heads scroll
+        visible = self.panels[:2]
+        self.panelScroll.setMinimumHeight(sum(panel.minimumHeight() for panel in visible)
+                                          + self.panelLayout.spacing() * (len(visible) - 1))
+
+        self.update_visibility()
+        self.registerButton.setEnabled(self.tabs.currentIndex() == 1 and len(self.sensors) > 1)
+
+        self.pointsKeys = [None] * len(self.sensors)
+        self.spareColors = [None] * len(self.sensors)
+        self.surfaceKey = None
+        self.stackKey = None
+        self.stackRow = None
+        self.frameKey = None
+        self.framePaths = None
+        self.prefetcher.set_sensors(self.sensors)
+        self.frameLoader.set_sensors(self.sensors)
+
+    def panel_title(self, index, sensor):
+        # The original two-head line keeps its left/right naming
+        if len(self.sensors) == 2:
+            return ("Sensor 1 (Lewy)", "Sensor 2 (Prawy)")[index]
+        return f"Sensor {index + 1} ({sensor.prefix})"
+
+    def paths(self, folder, suffix):
+        return tuple(sensor.path(folder, suffix) for sensor in self.sensors)
+
+    def processed3d(self):
+        return all(sensor.processed3d for sensor in self.sensors)
+
     def tab_change_handler(self):
-        if self.tabs.currentIndex() == 0:
-            self.sensor1ApplyButton.setEnabled(False)
-            self.sensor2ApplyButton.setEnabled(False)
-
-        if self.tabs.currentIndex() == 1:
-            self.sensor1ApplyButton.setEnabled(True)
-            self.sensor2ApplyButton.setEnabled(True)
-            if not self.s1.processed3d or not self.s2.processed3d:
-                self.s1.process_image3d()
-                self.s2.process_image3d()
-                self.apply_sensor1_values()
-                self.apply_sensor2_values()
-
-    def update_image_view(self, im1: str, im2: str):
-        try:
-            self.s1.open_image(im1)
-            self.s2.open_image(im2)
-        except FileNotFoundError as fnfe:
-            dialog = QErrorMessage()
-            dialog.showMessage(str(fnfe))
-            dialog.exec_()
-            self.refreshRequired.emit()
-
-        maxVal = np.max((np.max(self.s1.imageArray), np.max(self.s2.imageArray)))
-        self.s1.maxVal = maxVal
-        self.s2.maxVal = maxVal
-
-        self.s1.process_image2d()
-        self.s2.process_image2d()
-
-        if self.tabs.currentIndex() == 1:
-            self.s1.process_image3d()
-            self.s2.process_image3d()
-
-        self.imageView.setImage(np.concatenate((self.s1.imageArray, self.s2.imageArray)))
-
-        # Delete previous 3D data
-        self.view1.setData(pos=None, color=None)
-        self.view2.setData(pos=None, color=None)
-
-        if self.tabs.currentIndex() == 1:
-            self.apply_sensor1_values()
-            self.apply_sensor2_values()
-
-    def update_sensor1_values(self):
-        self.s1.xOffset = self.sensor1XOffsetSpinbox.value()
-        self.s1.yOffset = self.sensor1YOffsetSpinbox.value()
-        self.s1.zOffset = self.sensor1ZOffsetSpinbox.value()
-
-        self.s1.xAngle = self.sensor1XAngleSpinbox.value()
-        self.s1.yAngle = self.sensor1YAngleSpinbox.value()
-        self.s1.zAngle = self.sensor1ZAngleSpinbox.value()
-
-    def update_sensor2_values(self):
-        self.s2.xOffset = self.sensor2XOffsetSpinbox.value()
-        self.s2.yOffset = self.sensor2YOffsetSpinbox.value()
-        self.s2.zOffset = self.sensor2ZOffsetSpinbox.value()
-
-        self.s2.xAngle = self.sensor2XAngleSpinbox.value()
-        self.s2.yAngle = self.sensor2YAngleSpinbox.value()
-        self.s2.zAngle = self.sensor2ZAngleSpinbox.value()
-
-    def reset_sensor1_values(self):
-        self.s1.xOffset = 0.0
-        self.s1.yOffset = 0.0
-        self.s1.zOffset = 0.0
-        self.s1.xAngle = 0.0
-        self.s1.yAngle = 0.0
-        self.s1.zAngle = 0.0
-
-        self.sensor1XOffsetSpinbox.setValue(0.0)
-        self.sensor1YOffsetSpinbox.setValue(0.0)
-        self.sensor1ZOffsetSpinbox.setValue(0.0)
-        self.sensor1XAngleSpinbox.setValue(0.0)
-        self.sensor1YAngleSpinbox.setValue(0.0)
-        self.sensor1ZAngleSpinbox.setValue(0.0)
-
-    def reset_sensor2_values(self):
-        self.s2.xOffset = 0.0
-        self.s2.yOffset = 0.0
-        self.s2.zOffset = 0.0
-        self.s2.xAngle = 0.0
-        self.s2.yAngle = 0.0
-        self.s2.zAngle = 0.0
-
-        self.sensor2XOffsetSpinbox.setValue(0.0)
-        self.sensor2YOffsetSpinbox.setValue(0.0)
-        self.sensor2ZOffsetSpinbox.setValue(0.0)
-        self.sensor2XAngleSpinbox.setValue(0.0)
-        self.sensor2YAngleSpinbox.setValue(0.0)
-        self.sensor2ZAngleSpinbox.setValue(0.0)
-
-    def save_colormap1(self, colormap):
-        self.s1.colormap = colormap
-
-    def save_colormap2(self, colormap):
-        self.s2.colormap = colormap
-
-    def apply_sensor1_values(self):
-        self.s1.transform()
-        self.thread1 = QThread()
-        self.worker1 = ColormapWorker(self.s1.pointsArray)
-        self.worker1.moveToThread(self.thread1)
-        self.thread1.started.connect(self.worker1.generate_colormap)
-        self.worker1.finished.connect(self.save_colormap1)
-        self.worker1.finished.connect(lambda: self.view1.setData(pos=self.s1.pointsArray, color=self.s1.colormap))
-        self.worker1.finished.connect(self.thread1.quit)
-        self.worker1.finished.connect(self.worker1.deleteLater)
-        self.thread1.finished.connect(self.thread1.deleteLater)
-        self.thread1.start()
-
-    def apply_sensor2_values(self):
-        self.s2.transform()
-        self.thread2 = QThread()
-        self.worker2 = ColormapWorker(self.s2.pointsArray)
-        self.worker2.moveToThread(self.thread2)
-        self.thread2.started.connect(self.worker2.generate_colormap)
-        self.worker2.finished.connect(self.save_colormap2)
-        self.worker2.finished.connect(lambda: self.view2.setData(pos=self.s2.pointsArray, color=self.s2.colormap))
-        self.worker2.finished.connect(self.thread2.quit)
-        self.worker2.finished.connect(self.worker2.deleteLater)
-        self.thread2.finished.connect(self.thread2.deleteLater)
-        self.thread2.start()
+        for panel in self.panels:
+            panel.applyButton.setEnabled(self.tabs.currentIndex() == 1)
+        self.registerButton.setEnabled(self.tabs.currentIndex() == 1 and len(self.sensors) > 1)
+
+        if self.tabs.currentIndex() != 1 or self.framePaths is None:
+            return
+        # A frame that already has its axes is drawn right away. A 2D-only load still in flight is requested again
+        # by show_frames once it arrives
+        if not self.processed3d():
+            self.frameLoader.request(self.framePaths, process3d=True)
+        else:
+            self.stack_frame()
+            self.apply_all()
+
+    def update_image_view(self, paths):
+        # Decoding and processing run on the executor, show_frames receives the newest result
+        self.framePaths = tuple(paths)
+        self.frameLoader.request(self.framePaths, self.tabs.currentIndex() == 1)
+
+    def show_frames(self, key, frames):
+        if len(frames) != len(self.sensors):
+            return
+        newFrame = key != self.frameKey
+        self.frameKey = key
+        for sensor, frame in zip(self.sensors, frames):
+            sensor.load_frame(frame)
+
+        if newFrame:
+            with profiler.measure("image"):
+                self.imageView.setImage(np.concatenate([sensor.imageArray for sensor in self.sensors]))
+
+            # Delete previous 3D data, everything is uploaded again once the frame is drawn in 3D
+            for lod in self.lods:
+                lod.clear()
+            self.pointsKeys = [None] * len(self.sensors)
+            self.surfaceKey = None
+
+        if self.tabs.currentIndex() == 1 and self.processed3d():
+            self.stack_frame()
+            self.apply_all()
+        elif self.tabs.currentIndex() == 1:
+            self.frameLoader.request(self.framePaths, process3d=True)
+
+    def show_error(self, message):
+        dialog = QErrorMessage()
+        dialog.showMessage(message)
+        dialog.exec_()
+
+    def show_load_error(self, message):
+        # A file that failed to load may be gone, the listing is rescanned
+        self.show_error(message)
+        self.refreshRequired.emit()
+
+    def update_sensor_values(self, index):
+        sensor = self.sensors[index]
+        sensor.xOffset, sensor.yOffset, sensor.zOffset, sensor.xAngle, sensor.yAngle, sensor.zAngle = \
+            self.panels[index].pose()
+
+        # Poses are applied on the GPU, so following the spinboxes live costs nothing
+        if self.livePreviewCheckbox.isChecked() and sensor.processed3d:
+            self.pose_sensor(index)
+
+    def set_coarse(self, coarse):
+        if self.surfaceCheckbox.isChecked():
+            return
+        for lod in self.lods:
+            lod.set_coarse(coarse)
+
+    def pose_sensor(self, index):
+        matrix = self.sensors[index].pose_matrix()
+        self.views[index].setTransform(pose_transform(matrix, self.SCALE))
+        self.surfaces[index].set_pose(matrix)
+        self.volumes[index].set_pose(matrix)
+
+    def load_registration(self, folder):
+        # Poses found earlier for this folder replace the ones of the heads they belong to
+        poses = self.registrationCache.load(folder)
+        for index, sensor in enumerate(self.sensors):
+            if sensor.prefix in poses:
+                self.set_sensor_pose(index, poses[sensor.prefix])
+
+    def set_sensor_pose(self, index, pose):
+        self.panels[index].set_pose(pose)
+        sensor = self.sensors[index]
+        sensor.xOffset, sensor.yOffset, sensor.zOffset, sensor.xAngle, sensor.yAngle, sensor.zAngle = \
+            self.panels[index].pose()
+        if sensor.processed3d:
+            self.pose_sensor(index)
+
+    def register_sensors(self):
+        if len(self.sensors) < 2 or not self.processed3d() or self.framePaths is None:
+            return
+
+        # The shown frame and the cached ones around it, a single frame of a periodic surface fits in several places
+        folder = os.path.dirname(self.framePaths[0])
+        frames = [tuple(sensor.frame() for sensor in self.sensors)]
+        row = self.fileModel.row(os.path.basename(self.framePaths[0])[len(self.sensors[0].prefix):])
+        for distance in range(1, self.PREFETCH_RADIUS + 1):
+            for neighbour in (row + distance, row - distance):
+                if len(frames) < self.REGISTRATION_FRAMES and 0 <= neighbour < self.fileModel.count():
+                    cached = self.frameCache.peek(self.frameCache.key(*self.paths(folder, self.fileModel.suffix(neighbour))))
+                    if cached is not None:
+                        frames.append(cached)
+
+        # Works on copies in the current poses, which serve as the starting guess
+        poses = [sensor.pose() for sensor in self.sensors]
+
+        def register():
+            with profiler.measure("registration"):
+                copies = []
+                for frame in frames:
+                    copies.append([])
+                    for sensor, sensorFrame, pose in zip(self.sensors, frame, poses):
+                        copy = sensor.copy()
+                        copy.load_frame(sensorFrame)
+                        if not copy.processed3d:
+                            copy.process_image3d()
+                        copy.xOffset, copy.yOffset, copy.zOffset, copy.xAngle, copy.yAngle, copy.zAngle = pose
+                        copies[-1].append(copy)
+                return register_all(copies)
+
+        sensors = list(self.sensors)
+        self.scheduler.submit("registration", lambda result: self.registration_ready(folder, sensors, result), register)
+
+    def registration_ready(self, folder, sensors, result):
+        if sensors != self.sensors:
+            return
+        poses, results = result
+        previous = [sensor.pose() for sensor in self.sensors]
+        for index, pose in enumerate(poses):
+            self.set_sensor_pose(index, pose)
+
+        # The fit is shown first, it is only kept for the folder once confirmed
+        lines = [f"{moving.prefix} → {fixed.prefix}: RMS {rms:.2f} mm, {iterations} iteracji"
+                 for fixed, moving, (rms, iterations) in zip(self.sensors, self.sensors[1:], results)]
+        answer = QMessageBox.question(self, "Dopasowanie czujników",
+                                      "\n".join(lines) + "\n\nZachować dopasowanie dla tego folderu?")
+        if answer == QMessageBox.Yes:
+            self.registrationCache.store(folder, {sensor.prefix: sensor.pose() for sensor in self.sensors})
+        else:
+            for index, pose in enumerate(previous):
+                self.set_sensor_pose(index, pose)
+
+    def update_visibility(self):
+        surfaceMode = self.surfaceCheckbox.isChecked()
+        for view, surface, volume in zip(self.views, self.surfaces, self.volumes):
+            view.setVisible(not surfaceMode and not self.stacking())
+            surface.set_visible(surfaceMode)
+            volume.set_visible(self.stacking())
+
+    def surface_mode_toggled(self, checked):
+        self.update_visibility()
+
+        if self.tabs.currentIndex() == 1 and self.processed3d():
+            self.apply_all()
+
+    def stack_mode_toggled(self, checked):
+        # Every toggle starts an empty stack, turning it off also frees the ring buffers
+        for volume in self.volumes:
+            volume.clear(release=not checked)
+        self.stackKey = None
+        self.stackRow = None
+        self.pointsKeys = [None] * len(self.sensors)
+        self.update_visibility()
+
+        if self.tabs.currentIndex() == 1 and self.processed3d():
+            self.stack_frame()
+            self.apply_all()
+
+    def stacking(self):
+        return self.stackCheckbox.isChecked() and not self.surfaceCheckbox.isChecked()
+
+    def stack_frame(self):
+        # Places the shown frame along the travel axis by its row in the timestamp ordered list, so frames skipped by
+        # the auto display or by clicking ahead leave their gap. An older frame (jumping back in the list) or one
+        # further ahead than the whole stack starts a new stack
+        if not self.stacking() or self.frameKey == self.stackKey:
+            return
+        row = self.fileModel.row(os.path.basename(self.frameKey[0][0])[len(self.sensors[0].prefix):])
+        if self.stackRow is not None and 0 < row - self.stackRow <= self.STACK_FRAMES:
+            self.stackPosition += row - self.stackRow
+        elif self.stackRow is None or row != self.stackRow:
+            for volume in self.volumes:
+                volume.clear()
+            self.stackPosition = 0
+        self.stackKey = self.frameKey
+        self.stackRow = row
+
+    def upload_surfaces(self):
+        if self.surfaceKey == self.frameKey or not self.processed3d():
+            return
+
+        # Colors come from the untransformed cloud, so posing the surface never touches the vertex data. They are
+        # computed on the scheduler like the point colors, one slot per head
+        self.surfaceKey = self.frameKey
+        for index, sensor in enumerate(self.sensors):
+            grid = sensor.grid()
+            self.scheduler.submit(("surface", index),
+                                  lambda colors, index=index, sensor=sensor, grid=grid, key=self.frameKey:
+                                  self.surface_ready(index, sensor, key, grid, colors),
+                                  grid_colors, grid, height_colormap)
+
+    def surface_ready(self, index, sensor, key, grid, colors):
+        if index >= len(self.sensors) or self.sensors[index] is not sensor or key != self.frameKey:
+            return
+        with profiler.measure("upload"):
+            self.surfaces[index].set_grid(grid, colors)
+        # The Z shift of the model matrix comes with the grid
+        self.surfaces[index].set_pose(sensor.pose_matrix())
+
+    def stop_workers(self):
+        self.scheduler.shutdown()
+        self.prefetcher.shutdown()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def apply_all(self):
+        for index in range(len(self.sensors)):
+            self.apply_sensor_values(index)
+
+    def apply_sensor_values(self, index):
+        if self.surfaceCheckbox.isChecked():
+            self.upload_surfaces()
+        else:
+            self.upload_points(index)
+        self.pose_sensor(index)
+
+    def upload_points(self, index):
+        # Vertex data only changes with the frame, the pose is the item transform
+        if self.pointsKeys[index] == self.frameKey:
+            return
+        self.pointsKeys[index] = self.frameKey
+
+        sensor = self.sensors[index]
+        sensor.pointsArray = sensor.points()
+        position = self.stackPosition if self.stacking() and self.stackKey == self.frameKey else None
+        # Only the spare buffer is reused, the one handed to the view is still drawn from. A superseded job may still be
+        # writing into the spare, a new one is allocated then
+        buffer = None if self.scheduler.busy(("points", index)) else self.spareColors[index]
+        self.spareColors[index] = None
+        self.scheduler.submit(("points", index), lambda colormap: self.colormap_ready(index, sensor, colormap, position),
+                              generate_colors, sensor.pointsArray, height_colormap, buffer)
+
+    def colormap_ready(self, index, sensor, colormap, position=None):
+        if index >= len(self.sensors) or self.sensors[index] is not sensor:
+            return
+        with profiler.measure("upload"):
+            if position is not None and self.stacking():
+                shape = sensor.imageArray.shape
+                self.volumes[index].append(position, sensor.pointsArray, colormap, shape, shape[1] * sensor.yStep)
+                # Copied into the ring, so the buffer is free again right away
+                self.spareColors[index] = colormap
+            else:
+                # pyqtgraph keeps the array without copying, the previously shown one becomes the spare
+                self.spareColors[index] = sensor.colormap
+                sensor.colormap = colormap
+                self.lods[index].set_data(sensor.pointsArray, sensor.colormap, sensor.imageArray.shape)
 
 
 if __name__ == "__main__":